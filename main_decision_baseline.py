@@ -1,25 +1,31 @@
 import os
+import itertools
 import configparser
 import argparse
+from collections import OrderedDict
 from datetime import datetime
 
 import torch
 
-from subattack.utils.data import generate_1by1
 from subattack.utils.data import get_loaders
-from subattack.utils.data import idx_to_label
-from subattack.utils.results import AttackResult
-from subattack.utils.results import AttackDetailCollection
+from subattack.utils.remote import RemoteModel
+from subattack.utils.remote import RemotePredictor
+from subattack.utils.runner import AttackRunner
+from subattack.utils.runner import get_original_dir
 from subattack.utils import ModulePredictor
+from subattack.utils import CachedPredictor
 
 
 from subattack.strategies import ConventionFactory
 from subattack.strategies import InitializerFactory
 from subattack.strategies import SamplerFactory
+from subattack.strategies.samplers import PrefetchingSampler
 from subattack.strategies import AdvCheckerFactory
 from subattack.strategies import ModelFactory
+from subattack.strategies.models import MixedPrecisionModel
 
 from subattack.attackers import BoundaryAttackerWithStopRadius
+from subattack.attackers import OptAttacker
 
 
 parser = argparse.ArgumentParser()
@@ -31,41 +37,80 @@ parser.add_argument(
     '--section',
     default='DEFAULT'
 )
+parser.add_argument(
+    '--workers',
+    type=int,
+    default=1
+)
+parser.add_argument(
+    '--resume',
+    default=None
+)
+parser.add_argument(
+    '--threads',
+    type=int,
+    default=1
+)
 args = parser.parse_args()
 
 config = configparser.ConfigParser()
 config.read(args.config)
 params = config[args.section]
 
-result_dir = os.path.join(
-    params.get('result_dir'),
-    'decision_baseline',
-    args.section,
-    '{:%Y-%m-%d-%H-%M-%S}'.format(datetime.now())
-)
+if args.resume is None:
+    result_dir = os.path.join(
+        params.get('result_dir'),
+        'decision_baseline',
+        args.section,
+        '{:%Y-%m-%d-%H-%M-%S}'.format(datetime.now())
+    )
+else:
+    result_dir = args.resume
 
 if not os.path.exists(result_dir):
     os.makedirs(result_dir)
 
-with open(os.path.join(result_dir, 'config.ini'), 'w') as backup_configfile:
-    config.write(backup_configfile)
+if args.resume is None:
+    with open(
+            os.path.join(result_dir, 'config.ini'), 'w'
+    ) as backup_configfile:
+        config.write(backup_configfile)
 
 torch.manual_seed(params.getint('seed'))
 torch.backends.cudnn.deterministic = True
 torch.backends.cudnn.benchmark = False
 
 os.environ['TORCH_HOME'] = params.get('torch_home')
-model = ModelFactory().create_model(
-    params.get('model_name'), params.get('device')
-)
-predictor = ModulePredictor(model)
+if params.get('remote_url'):
+    model = RemoteModel(
+        params.get('remote_url'),
+        encoding=params.get('remote_encoding'),
+        max_concurrency=params.getint('remote_concurrency'),
+        max_batch_size=params.getint('remote_batch_size') or None,
+        max_retries=params.getint('remote_retries'),
+        backoff=params.getfloat('remote_backoff'),
+        rate=params.getfloat('remote_rate') or None,
+    )
+    # only the labels come back over the network
+    predictor = RemotePredictor(model)
+else:
+    model = ModelFactory().create_model(
+        params.get('model_name'), params.get('device'),
+        optimize=params.get('model_optimize'),
+        precision=params.get('model_precision'),
+        margin=params.getfloat('precision_margin'),
+    )
+    predictor = ModulePredictor(model)
+if params.getint('cache_size') > 0:
+    predictor = CachedPredictor(predictor, params.getint('cache_size'))
 
 manifold_loader, attack_loader = get_loaders(
     params.get('data_dir'),
     params.getint('size_manifold'),
     params.getint('size_attack'),
     params.getint('num_workers'),
-    params.getint('batch_size')
+    params.getint('batch_size'),
+    params.getint('seed')
 )
 
 adv_checker = AdvCheckerFactory().create_adv_checker(
@@ -84,51 +129,167 @@ initializer = InitializerFactory().create_initializer(
 sampler = SamplerFactory().create_sampler(
     name=params.get('sampler'),
     shape=convention.shape,
-    device=params.get('device')
+    device=params.get('device'),
+    rotation_size=params.getint('rotation_size') or None,
 )
+if params.getint('sampler_prefetch') > 0:
+    sampler = PrefetchingSampler(
+        sampler, params.getint('seed'), params.getint('sampler_prefetch')
+    )
+
+
+def manual_seed(seed):
+    torch.manual_seed(seed)
+    if isinstance(sampler, PrefetchingSampler):
+        sampler.manual_seed(seed)
 
-boundary_attacker = BoundaryAttackerWithStopRadius(
-    predictor,
-    params.getfloat('outer_ratio'),
-    params.getfloat('inner_ratio'),
-    params.getint('budget'),
-    params.getfloat('stop_radius'),
-    convention,
-    initializer,
-    sampler,
-    adv_checker,
-)
 
-attack_detail_collection = AttackDetailCollection()
+def create_attacker(predictor):
+    if params.get('attacker') == 'boundary':
+        return BoundaryAttackerWithStopRadius(
+            predictor,
+            params.getfloat('outer_ratio'),
+            params.getfloat('inner_ratio'),
+            params.getint('budget'),
+            params.getfloat('stop_radius'),
+            convention,
+            initializer,
+            sampler,
+            adv_checker,
+            candidate_size=params.getint('candidate_size'),
+        )
+    elif params.get('attacker') == 'opt':
+        assert params.getint('attack_batch_size') == 1
+        return OptAttacker(
+            predictor,
+            params.getfloat('scale_ratio'),
+            params.getint('search_size'),
+            params.getint('sample_size'),
+            params.getfloat('smoothing'),
+            params.getfloat('step_size'),
+            params.getfloat('tolerance'),
+            params.getint('budget'),
+            convention,
+            sampler,
+            adv_checker,
+            stop_radius=params.getfloat('stop_radius'),
+        )
+    else:
+        raise Exception('unsupported attacker')
 
-count = 0
-for image, label in generate_1by1(attack_loader, params.get('device')):
 
-    pred_label = predictor.predict_individual(image)
-    if pred_label != label:
-        continue
+attacker = create_attacker(predictor)
 
-    torch.manual_seed(params.getint('seed'))
 
-    print(f"{count+1}/{params.getint('num_attack')}")
-    adv_image = boundary_attacker.solve(image, label)
-    attack_result = AttackResult(
-        image, label,
+def solve(image, label, attacker=attacker, predictor=predictor):
+    cached = isinstance(predictor, CachedPredictor)
+    hit_count = predictor.hit_count if cached else None
+    adv_image = attacker.solve(image, label)
+    if cached:
+        hit_count = predictor.hit_count - hit_count
+    return (
         adv_image, predictor.predict_individual(adv_image),
-        boundary_attacker.cost, adv_checker
+        attacker.cost, hit_count
     )
 
-    attack_result.save_image(count, idx_to_label, result_dir)
-    attack_result.save_adv_image(count, idx_to_label, result_dir)
 
-    attack_result.print_detail()
+def solve_stream(image_label_iterator):
+    while True:
+        batch = list(itertools.islice(
+            image_label_iterator, params.getint('attack_batch_size')
+        ))
+        if not batch:
+            return
 
-    attack_detail_collection.append(attack_result.detail)
-    attack_detail_collection.save_detail(result_dir)
+        image_list, label_list = zip(*batch)
+        manual_seed(params.getint('seed'))
+        adv_image_array = attacker.solve_batch(
+            torch.stack(image_list), torch.stack(label_list)
+        )
+        hit_list = (
+            attacker.hit_list if isinstance(predictor, CachedPredictor)
+            else [None] * len(image_list)
+        )
+        yield from zip(
+            adv_image_array, predictor.predict_batch(adv_image_array),
+            attacker.cost_list, hit_list
+        )
 
-    count += 1
-    if count >= params.getint('num_attack'):
-        break
 
-attack_detail_collection.print_summary()
-attack_detail_collection.save_summary(result_dir)
+def solve_in_thread(client, image, label):
+    predictor = ModulePredictor(client)
+    result = solve(image, label, create_attacker(predictor), predictor)
+    # the label of the result is queried on top of the cost
+    assert client.query_count == result[2] + 1
+    return result
+
+
+def count_queries():
+    counts = OrderedDict()
+    if isinstance(model, MixedPrecisionModel):
+        counts['bfloat16'] = model.query_count
+        counts['fallback'] = model.fallback_count
+    if isinstance(model, RemoteModel):
+        counts['request'] = model.request_count
+        counts['retry'] = model.retry_count
+    if isinstance(predictor, CachedPredictor):
+        counts['hit'] = predictor.hit_count
+        counts['miss'] = predictor.miss_count
+    return counts
+
+
+runner = AttackRunner(
+    attack_loader, predictor.predict_batch,
+    adv_checker, result_dir, params.getint('num_attack'),
+    lambda order: manual_seed(params.getint('seed')),
+    device=params.get('device'),
+    save_original=params.get('save_original'),
+    original_dir=get_original_dir(
+        params.get('result_dir'),
+        params.get('remote_url') or params.get('model_name'),
+        params.get('data_dir'), params.getint('seed'),
+        params.getint('size_manifold'), params.getint('size_attack')
+    ),
+    save_threads=params.getint('save_threads'),
+    count_queries=count_queries,
+)
+
+if args.workers > 1:
+    assert params.getint('attack_batch_size') == 1
+    runner.run_sharded(solve, args.workers)
+elif args.threads > 1:
+    assert params.getint('attack_batch_size') == 1
+    assert params.getint('sampler_prefetch') == 0
+    assert params.getint('cache_size') == 0
+    runner.run_threaded(
+        solve_in_thread, model, args.threads,
+        params.getint('broker_batch_size'), params.getfloat('broker_wait')
+    )
+elif params.getint('attack_batch_size') == 1:
+    runner.run(solve)
+else:
+    runner.run_stream(solve_stream)
+
+# summed over the worker processes with --workers
+counts = runner.query_counts
+
+if isinstance(model, MixedPrecisionModel):
+    print(
+        f"bfloat16: {counts['fallback']} of {counts['bfloat16']} queries "
+        f"rerun in float32, fallback rate "
+        f"{counts['fallback'] / max(counts['bfloat16'], 1):f}"
+    )
+
+if isinstance(model, RemoteModel):
+    print(
+        f"remote: {counts['request']} requests, {counts['retry']} retries"
+    )
+
+if isinstance(predictor, CachedPredictor):
+    lookup_count = counts['hit'] + counts['miss']
+    print(
+        f"cache: {counts['hit']} hits, {counts['miss']} misses, "
+        f"hit rate {counts['hit'] / max(lookup_count, 1):f}"
+    )
+
+runner.close()
@@ -1,17 +1,18 @@
 import os
 import configparser
 import argparse
+from collections import OrderedDict
 from datetime import datetime
 
 import torch
 
-from subattack.utils.data import generate_1by1
 from subattack.utils.data import get_loaders
-from subattack.utils.data import idx_to_label
-from subattack.utils.results import AttackResult
-from subattack.utils.results import AttackDetailCollection
+from subattack.utils.remote import RemoteModel
+from subattack.utils.runner import AttackRunner
+from subattack.utils.runner import get_original_dir
 
 from subattack.strategies.svd import SvdBasisFetcherFactory
+from subattack.strategies.svd import StreamingSvdBasisFetcher
 from subattack.strategies.adv_checkers import AdvCheckerFactory
 from subattack.strategies.constraints import ConstraintFactory
 from subattack.strategies.conventions import ConventionFactory
@@ -20,6 +21,8 @@ from subattack.strategies.initializers import InitializerFactory
 from subattack.strategies.loss import LossEvaluatorFactory
 from subattack.strategies.models import ModelFactory
 from subattack.strategies.samplers import SamplerFactory
+from subattack.strategies.samplers import PrefetchingSampler
+from subattack.strategies.samplers import SubspaceSphereSampler
 from subattack.strategies.steepest import SteepestGradientTransformerFactory
 from subattack.strategies.pools import PoolFetcherFactory
 
@@ -35,40 +38,73 @@ parser.add_argument(
     '--section',
     default='DEFAULT'
 )
+parser.add_argument(
+    '--workers',
+    type=int,
+    default=1
+)
+parser.add_argument(
+    '--resume',
+    default=None
+)
+parser.add_argument(
+    '--threads',
+    type=int,
+    default=1
+)
 args = parser.parse_args()
 
 config = configparser.ConfigParser()
 config.read(args.config)
 params = config[args.section]
 
-result_dir = os.path.join(
-    params.get('result_dir'),
-    'score',
-    args.section,
-    '{:%Y-%m-%d-%H-%M-%S}'.format(datetime.now())
-)
+if args.resume is None:
+    result_dir = os.path.join(
+        params.get('result_dir'),
+        'score',
+        args.section,
+        '{:%Y-%m-%d-%H-%M-%S}'.format(datetime.now())
+    )
+else:
+    result_dir = args.resume
 
 if not os.path.exists(result_dir):
     os.makedirs(result_dir)
 
-with open(os.path.join(result_dir, 'config.ini'), 'w') as backup_configfile:
-    config.write(backup_configfile)
+if args.resume is None:
+    with open(
+            os.path.join(result_dir, 'config.ini'), 'w'
+    ) as backup_configfile:
+        config.write(backup_configfile)
 
 torch.manual_seed(params.getint('seed'))
 torch.backends.cudnn.deterministic = True
 torch.backends.cudnn.benchmark = False
 
 os.environ['TORCH_HOME'] = params.get('torch_home')
-model = ModelFactory().create_model(
-    params.get('model_name'), params.get('device')
-)
+if params.get('remote_url'):
+    model = RemoteModel(
+        params.get('remote_url'),
+        encoding=params.get('remote_encoding'),
+        max_concurrency=params.getint('remote_concurrency'),
+        max_batch_size=params.getint('remote_batch_size') or None,
+        max_retries=params.getint('remote_retries'),
+        backoff=params.getfloat('remote_backoff'),
+        rate=params.getfloat('remote_rate') or None,
+    )
+else:
+    model = ModelFactory().create_model(
+        params.get('model_name'), params.get('device'),
+        optimize=params.get('model_optimize'),
+    )
 
 manifold_loader, attack_loader = get_loaders(
     params.get('data_dir'),
     params.getint('size_manifold'),
     params.getint('size_attack'),
     params.getint('num_workers'),
-    params.getint('batch_size')
+    params.getint('batch_size'),
+    params.getint('seed')
 )
 
 adv_checker = AdvCheckerFactory().create_adv_checker(
@@ -89,37 +125,91 @@ loss_evaluator = LossEvaluatorFactory().create_loss_evaluator(
     name=params.get('loss')
 )
 
-pool_fetcher = PoolFetcherFactory().create_pool_fetcher(
-    name=params.get('pool'),
-    loader=manifold_loader,
-    max_size=params.getint('pool_size'),
-    device=params.get('device')
-)
+if not (
+        InitializerFactory().needs_basis(params.get('initializer')) or
+        SamplerFactory().needs_basis(params.get('sampler'))
+):
+    # e.g. the implicit low-frequency samplers need no basis
+    basis_fetcher = None
+elif params.get('svd') == 'streaming':
+    basis_fetcher = StreamingSvdBasisFetcher(
+        loader=manifold_loader,
+        pool_size=params.getint('pool_size'),
+        subspace_size=params.getint('subspace_size'),
+        position=params.get('position'),
+        pool=params.get('pool'),
+        storage=params.get('pool_storage'),
+        deduplicate=params.getboolean('pool_deduplicate'),
+        storage_dir=params.get('svd_cache_dir') or None,
+        num_threads=params.getint('svd_threads'),
+    )
+else:
+    pool_fetcher = PoolFetcherFactory().create_pool_fetcher(
+        name=params.get('pool'),
+        loader=manifold_loader,
+        max_size=params.getint('pool_size'),
+        device=params.get('device'),
+        storage=params.get('pool_storage'),
+        path=params.get('pool_file') or None,
+        deduplicate=params.getboolean('pool_deduplicate'),
+    )
 
-pool = pool_fetcher.fetch()
+    pool = pool_fetcher.fetch()
 
-basis_fetcher = SvdBasisFetcherFactory().create_svd_basis_fetcher(
-    name=params.get('svd'),
-    pool=pool,
-    subspace_size=params.getint('subspace_size'),
-    position=params.get('position'),
-)
-basis = basis_fetcher.fetch()
+    basis_fetcher = SvdBasisFetcherFactory().create_svd_basis_fetcher(
+        name=params.get('svd'),
+        pool=pool,
+        subspace_size=params.getint('subspace_size'),
+        position=params.get('position'),
+        cache_dir=params.get('svd_cache_dir') or None,
+        oversampling=params.getint('svd_oversampling'),
+    )
+basis = None if basis_fetcher is None else basis_fetcher.fetch()
 
 initializer = InitializerFactory().create_initializer(
     name=params.get('initializer'),
     radius=params.getfloat('radius'),
     shape=convention.shape,
     basis=basis,
-    device=params.get('device')
+    device=params.get('device'),
+    band_start=params.getint('band_start'),
+    band_end=params.getint('band_end'),
+    resolution=params.getint('resolution'),
+    block_size=params.getint('basis_block_size') or None,
+    num_threads=params.getint('basis_threads'),
 )
 
 sampler = SamplerFactory().create_sampler(
     name=params.get('sampler'),
+    shape=convention.shape,
     basis=basis,
-    device=params.get('device')
+    device=params.get('device'),
+    band_start=params.getint('band_start'),
+    band_end=params.getint('band_end'),
+    resolution=params.getint('resolution'),
+    block_size=params.getint('basis_block_size') or None,
+    num_threads=params.getint('basis_threads'),
+    precision=params.get('basis_precision'),
+    rotation_size=params.getint('rotation_size') or None,
 )
 
+if (isinstance(sampler, SubspaceSphereSampler) and
+        params.get('basis_precision') != 'float32'):
+    for key, value in sampler.check_precision(basis).items():
+        print('{}: {}'.format(key, value))
+
+if params.getint('sampler_prefetch') > 0:
+    sampler = PrefetchingSampler(
+        sampler, params.getint('seed'), params.getint('sampler_prefetch')
+    )
+
+
+def manual_seed(seed):
+    torch.manual_seed(seed)
+    if isinstance(sampler, PrefetchingSampler):
+        sampler.manual_seed(seed)
+
+
 gradient_estimator = GradientEstimatorFactory().create_gradient_estimator(
     name=params.get('gradient_estimator'),
     sampler=sampler,
@@ -127,38 +217,76 @@ gradient_estimator = GradientEstimatorFactory().create_gradient_estimator(
     sample_size=params.getint('sample_size')
 )
 
-gradient_attacker = GradientAttacker(
-    model, params.getfloat('step_size'), params.getint('budget'),
-    adv_checker, convention, initializer, gradient_estimator,
-    constraint, loss_evaluator, steepest_gradient_transformer
-)
 
-attack_detail_collection = AttackDetailCollection()
+def create_attacker(model):
+    return GradientAttacker(
+        model, params.getfloat('step_size'), params.getint('budget'),
+        adv_checker, convention, initializer, gradient_estimator,
+        constraint, loss_evaluator, steepest_gradient_transformer
+    )
+
 
-count = 0
-for image, label in generate_1by1(attack_loader, params.get('device')):
+gradient_attacker = create_attacker(model)
 
-    pred_label = model(image.unsqueeze(0)).squeeze().argmax()
-    if pred_label != label:
-        continue
 
-    print('{}/{}'.format(count+1, params.getint('num_attack')))
-    adv_image, adv_label, cost = gradient_attacker.solve(image, label)
-    attack_result = AttackResult(
-        image, label, adv_image, adv_label, cost, adv_checker
+def solve_stream(image_label_iterator):
+    return gradient_attacker.solve_stream(
+        image_label_iterator, params.getint('attack_batch_size')
     )
 
-    attack_result.save_image(count, idx_to_label, result_dir)
-    attack_result.save_adv_image(count, idx_to_label, result_dir)
-
-    attack_result.print_detail()
 
-    attack_detail_collection.append(attack_result.detail)
-    attack_detail_collection.save_detail(result_dir)
+def solve_in_thread(client, image, label):
+    result = create_attacker(client).solve(image, label)
+    assert client.query_count == result[2]
+    return result
+
+
+def count_queries():
+    counts = OrderedDict()
+    if isinstance(model, RemoteModel):
+        counts['request'] = model.request_count
+        counts['retry'] = model.retry_count
+    return counts
+
+
+runner = AttackRunner(
+    attack_loader, lambda image_array: model(image_array).argmax(dim=1),
+    adv_checker, result_dir, params.getint('num_attack'),
+    # seeded per image, so that serial, sharded and resumed runs draw the
+    # same random streams
+    lambda order: manual_seed(params.getint('seed') + order),
+    device=params.get('device'),
+    save_original=params.get('save_original'),
+    original_dir=get_original_dir(
+        params.get('result_dir'),
+        params.get('remote_url') or params.get('model_name'),
+        params.get('data_dir'), params.getint('seed'),
+        params.getint('size_manifold'), params.getint('size_attack')
+    ),
+    save_threads=params.getint('save_threads'),
+    count_queries=count_queries,
+)
 
-    count += 1
-    if count >= params.getint('num_attack'):
-        break
+if args.workers > 1:
+    assert params.getint('attack_batch_size') == 1
+    runner.run_sharded(gradient_attacker.solve, args.workers)
+elif args.threads > 1:
+    assert params.getint('attack_batch_size') == 1
+    assert params.getint('sampler_prefetch') == 0
+    runner.run_threaded(
+        solve_in_thread, model, args.threads,
+        params.getint('broker_batch_size'), params.getfloat('broker_wait')
+    )
+elif params.getint('attack_batch_size') == 1:
+    runner.run(gradient_attacker.solve)
+else:
+    runner.run_stream(solve_stream)
+
+if isinstance(model, RemoteModel):
+    # summed over the worker processes with --workers
+    counts = runner.query_counts
+    print(
+        f"remote: {counts['request']} requests, {counts['retry']} retries"
+    )
 
-attack_detail_collection.print_summary()
-attack_detail_collection.save_summary(result_dir)
+runner.close()
@@ -0,0 +1,143 @@
+import os
+import time
+import argparse
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+from subattack.strategies.models import ModelFactory
+from subattack.utils.brokers import QueryBroker
+from subattack.utils.remote import decode_images
+from subattack.utils.remote import encode_output
+
+
+# serves a ModelFactory model for RemoteModel and RemotePredictor: POST
+# /logits or /labels with a batch of images encoded as in utils.remote;
+# concurrent requests share forward passes through a QueryBroker
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--model_name',
+    default='resnet50'
+)
+parser.add_argument(
+    '--device',
+    default='cpu'
+)
+parser.add_argument(
+    '--torch_home',
+    default=None
+)
+parser.add_argument(
+    '--optimize',
+    default='none'
+)
+# a bfloat16 model only serves /labels: its logits are too coarse for the
+# loss differences of score-based attacks
+parser.add_argument(
+    '--precision',
+    default='float32'
+)
+parser.add_argument(
+    '--margin',
+    type=float,
+    default=0.5
+)
+parser.add_argument(
+    '--host',
+    default='127.0.0.1'
+)
+parser.add_argument(
+    '--port',
+    type=int,
+    default=8000
+)
+parser.add_argument(
+    '--max_batch_size',
+    type=int,
+    default=256
+)
+parser.add_argument(
+    '--max_wait',
+    type=float,
+    default=0.005
+)
+# added to every answer, to stand in for the latency of a real network
+parser.add_argument(
+    '--delay',
+    type=float,
+    default=0.
+)
+args = parser.parse_args()
+
+if args.torch_home is not None:
+    os.environ['TORCH_HOME'] = args.torch_home
+model = ModelFactory().create_model(
+    args.model_name, args.device,
+    optimize=args.optimize,
+    precision=args.precision,
+    margin=args.margin,
+)
+broker = QueryBroker(model, args.max_batch_size, args.max_wait)
+
+
+class ModelRequestHandler(BaseHTTPRequestHandler):
+
+    # keeps the connections of the clients alive
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if self.path not in ('/logits', '/labels'):
+            self._reply(404, b'unknown path')
+            return
+
+        if self.path == '/logits' and args.precision != 'float32':
+            self._reply(
+                400, f'{args.precision} models only serve /labels'.encode()
+            )
+            return
+
+        try:
+            image_array = decode_images(
+                body, self.headers['X-Shape'], self.headers['X-Encoding']
+            )
+        except Exception as error:
+            self._reply(400, str(error).encode())
+            return
+
+        try:
+            output = broker.submit(image_array.to(args.device)).result()
+        except Exception as error:
+            self._reply(500, str(error).encode())
+            return
+
+        if self.path == '/labels':
+            output = output.argmax(dim=1)
+
+        time.sleep(args.delay)
+        self._reply(200, *encode_output(output))
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+server = ThreadingHTTPServer((args.host, args.port), ModelRequestHandler)
+server.daemon_threads = True
+print(f'serving {args.model_name} on http://{args.host}:{args.port}')
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    server.server_close()
+    broker.close()
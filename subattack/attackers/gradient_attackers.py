@@ -1,11 +1,15 @@
 import torch
 
+from subattack.utils.oracles import Oracle
+from subattack.utils.steps import drive
+from subattack.utils.steps import drive_continuous
 from subattack.strategies.adv_checkers import AdvChecker
 from subattack.strategies.initializers import Initializer
 from subattack.strategies.loss import LossEvaluator
 from subattack.strategies.conventions import Convention
 from subattack.strategies.constraints import Constraint
 from subattack.strategies.gradient_estimators import GradientEstimator
+from subattack.strategies.gradient_estimators import BatchGradientEstimator
 from subattack.strategies.steepest import SteepestGradientTransformer
 
 
@@ -26,6 +30,7 @@ class GradientAttacker:
             verbose=True,
     ):
         self._model = model
+        self._oracle = Oracle(model, loss_evaluator)
         self._step_size = step_size
         self._budget = budget
         self._adv_checker = adv_checker
@@ -39,24 +44,82 @@ class GradientAttacker:
 
     def solve(self, image, label):
 
+        if isinstance(self._gradient_estimator, BatchGradientEstimator):
+            return drive(self.solve_steps(image, label), self._model)
+        return self._solve_with_oracle(image, label)
+
+    def solve_steps(self, image, label):
+
+        # a generator yielding every batch of images the attack needs
+        # evaluated and receiving their logits back, see utils.steps; it
+        # queries the model exactly as solve does
+        assert isinstance(self._gradient_estimator, BatchGradientEstimator)
+
         perturbation = self._initialize(image)
         adv_image = perturbation + image
 
         total_cost = 0
         while True:
 
-            pred_label = self._predict_label(adv_image)
+            logits = yield adv_image.unsqueeze(0)
+            loss = self._loss_evaluator.compute_from_logits(
+                logits, label.unsqueeze(0)
+            )
+            pred_label = logits.argmax(dim=1).squeeze(0)
             total_cost += 1
 
             if self._verbose:
-                loss = self._loss_evaluator.compute_individual(
-                    self._model, adv_image, label
-                )
                 print('{:>5d} {:>10.6f}'.format(total_cost, loss.item()))
 
             if ((self._adv_checker.successful(label, pred_label)) or
                     (total_cost >= self._budget)):
+                return adv_image, pred_label, total_cost
+
+            probe_array, directions = self._gradient_estimator.probe_batch(
+                adv_image.unsqueeze(0)
+            )
+            probe_logits = yield probe_array.flatten(0, 1)
+            probe_loss_array = self._loss_evaluator.compute_from_logits(
+                probe_logits, label.expand(probe_logits.shape[0])
+            ).unsqueeze(0)
+
+            gradient_array, gradient_cost = (
+                self._gradient_estimator.combine_batch(
+                    loss, probe_loss_array, directions
+                )
+            )
+
+            total_cost += gradient_cost
+            increment = self._steepest_gradient_transformer.transform(
+                gradient_array[0]
+            ) * self._step_size
 
+            perturbation = self._update(image, perturbation, increment)
+            adv_image = image + perturbation
+
+    def _solve_with_oracle(self, image, label):
+
+        # estimators which are not batched, e.g. the prior one, query the
+        # model on their own and cannot be run step-wise
+        perturbation = self._initialize(image)
+        adv_image = perturbation + image
+
+        total_cost = 0
+        while True:
+
+            oracle_result = self._oracle.query(adv_image, label)
+            pred_label = oracle_result.label
+            total_cost += 1
+
+            if self._verbose:
+                print('{:>5d} {:>10.6f}'.format(
+                    total_cost, oracle_result.loss.item()
+                ))
+
+            if ((self._adv_checker.successful(label, pred_label)) or
+                    (total_cost >= self._budget)):
+
+                self._oracle.clear()
                 return adv_image, pred_label, total_cost
 
             normalized_gradient, gradient_cost = self._estimate_gradient(
@@ -69,6 +132,31 @@ class GradientAttacker:
             perturbation = self._update(image, perturbation, increment)
             adv_image = image + perturbation
 
+    def solve_batch(self, image_array, label_array):
+
+        result_list = list(self.solve_stream(
+            zip(image_array, label_array), image_array.shape[0]
+        ))
+        adv_image_list, adv_label_list, cost_list = zip(*result_list)
+        return (
+            torch.stack(adv_image_list), torch.stack(adv_label_list),
+            list(cost_list)
+        )
+
+    def solve_stream(self, image_label_iterable, batch_size):
+
+        # continuous batching: up to batch_size attacks share every forward
+        # pass, and a finished attack is replaced by the next image right
+        # away; an attack sends its probes only once its label check says
+        # it goes on. The results are yielded in order
+        return drive_continuous(
+            (
+                self.solve_steps(image, label)
+                for image, label in image_label_iterable
+            ),
+            self._model, batch_size
+        )
+
     def _initialize(self, image):
         return self._project(
             self._initializer.initialize(), image
@@ -86,12 +174,9 @@ class GradientAttacker:
     def _project_perturbation(self, perturbation):
         return self._constraint.project(perturbation)
 
-    def _predict_label(self, image):
-        return self._model(image.unsqueeze(0)).squeeze().argmax()
-
     def _estimate_gradient(self, image, label):
         gradient, gradient_cost = self._gradient_estimator.estimate(
-            self._model, self._loss_evaluator, image, label
+            self._oracle, self._loss_evaluator, image, label
         )
         steepest_gradient = self._steepest_gradient_transformer.transform(
             gradient
@@ -2,6 +2,8 @@ import torch
 from abc import ABC, abstractmethod
 
 from subattack.utils import Predictor
+from subattack.utils import CachedPredictor
+from subattack.utils.steps import drive
 from subattack.strategies import Initializer
 from subattack.strategies import Sampler
 from subattack.strategies import Convention
@@ -18,12 +20,14 @@ class AbstractBoundaryAttacker(ABC):
             sampler: Sampler,
             adv_checker: AdvChecker,
             verbose=True,
+            candidate_size=1,
     ):
         self._predictor = predictor
 
         self._outer_ratio = outer_ratio
         self._inner_ratio = inner_ratio
         self._budget = budget
+        self._candidate_size = candidate_size
 
         self._convention = convention
         self._initializer = initializer
@@ -33,13 +37,25 @@ class AbstractBoundaryAttacker(ABC):
         self._verbose = verbose
 
         self._cost = 0
+        self._cost_array = None
+        self._hit_array = None
 
     def solve(self, image, label):
+        return drive(
+            self.solve_steps(image, label), self._predictor.predict_batch
+        )
+
+    def solve_steps(self, image, label):
+
+        # a generator yielding every batch of images the attack needs
+        # predicted and receiving their labels back, see utils.steps; the
+        # attacker keeps the state of the attack, so attacks run side by
+        # side need an attacker each
 
         self._cost = 0
 
         try:
-            adv_image = self._initialize(image, label)
+            adv_image = yield from self._initialize_steps(image, label)
         except InitializationException:
             return image
 
@@ -59,20 +75,69 @@ class AbstractBoundaryAttacker(ABC):
                 else:
                     return image
 
-            outer_image = self._outer_move(image, adv_image)
-            inner_image = self._inner_move(image, outer_image)
+            successful, adv_image = yield from self._move_steps(
+                image, label, adv_image
+            )
 
-            if self._adv_checker.successful(
-                    label, self._predict(inner_image)
-            ):
-                adv_image = inner_image
+            if successful:
 
                 if self._verbose:
                     print(
                         f'{self.cost:5d}, {(adv_image-image).norm().item():f}'
                     )
 
-    def _initialize(self, image, label):
+    def solve_batch(self, image_array, label_array):
+
+        self._cost_array = torch.zeros(
+            image_array.shape[0], dtype=torch.long, device=image_array.device
+        )
+        self._hit_array = torch.zeros_like(self._cost_array)
+
+        result_array = image_array.clone()
+        adv_image_array, active = self._initialize_batch(
+            image_array, label_array
+        )
+
+        while True:
+
+            for i in active.nonzero().flatten().tolist():
+                if self._ready_for_early_stop(
+                        image_array[i], label_array[i], adv_image_array[i]
+                ):
+                    result_array[i] = adv_image_array[i]
+                    active[i] = False
+                elif self._cost_array[i] >= self._budget:
+                    if self._constraint_satisfied(
+                            image_array[i], label_array[i], adv_image_array[i]
+                    ):
+                        result_array[i] = adv_image_array[i]
+                    active[i] = False
+
+            if not active.any():
+                return result_array
+
+            index = active.nonzero().squeeze(1)
+
+            candidate_size_array = (
+                self._budget - self._cost_array[index]
+            ).clamp(max=self._candidate_size)
+            self._cost_array[index] += candidate_size_array
+
+            adv_image_array[index], successful = self._move_batch(
+                image_array[index], label_array[index],
+                adv_image_array[index], candidate_size_array, index
+            )
+
+            if self._verbose and successful.any():
+                norm_array = self._norm_batch(
+                    adv_image_array[index] - image_array[index]
+                )
+                print(
+                    f'{self._cost_array[index].max().item():5d}, '
+                    f'{index.shape[0]:4d}, {norm_array.mean().item():f}'
+                )
+
+    def _initialize_steps(self, image, label):
         while True:
 
             if self.cost >= self._budget:
@@ -82,10 +147,35 @@ class AbstractBoundaryAttacker(ABC):
                 image + self._initializer.initialize()
             )
             if self._adv_checker.successful(
-                    self._predict(result), label
+                    (yield from self._predict_steps(result)), label
             ):
                 return result
 
+    def _initialize_batch(self, image_array, label_array):
+
+        adv_image_array = image_array.clone()
+        initialized = torch.zeros_like(self._cost_array, dtype=torch.bool)
+
+        while True:
+
+            pending = ~initialized & (self._cost_array < self._budget)
+            if not pending.any():
+                return adv_image_array, initialized
+
+            index = pending.nonzero().squeeze(1)
+
+            candidate_array = self._convention.project(
+                image_array[index] + torch.stack(
+                    [self._initializer.initialize() for _ in index]
+                )
+            )
+            successful = self._adv_checker.successful_batch(
+                label_array[index],
+                self._predict_batch(candidate_array, index)
+            )
+            adv_image_array[index[successful]] = candidate_array[successful]
+            initialized[index[successful]] = True
+
     @abstractmethod
     def _ready_for_early_stop(self, image, label, adv_image):
         pass
@@ -94,12 +184,105 @@ class AbstractBoundaryAttacker(ABC):
     def _constraint_satisfied(self, image, label, adv_image):
         pass
 
-    def _predict(self, image):
+    def _predict_steps(self, image):
         self._cost += 1
-        return self._predict_for_free(image)
+        return (yield image.unsqueeze(0)).squeeze(0)
+
+    def _predict_batch(self, image_array, index):
+        self._cost_array[index] += 1
+        return self._predict_rows(image_array, index)
+
+    def _predict_rows(self, image_array, owner):
+        # owner holds, for every row, the image of the batch it is for, so
+        # that the cache hits are counted per image
+        result = self._predictor.predict_batch(image_array)
+        if isinstance(self._predictor, CachedPredictor):
+            self._hit_array.index_add_(
+                0, owner, self._predictor.hit_mask.long()
+            )
+        return result
+
+    def _move_steps(self, image, label, adv_image):
+
+        if self._candidate_size == 1:
+            outer_image = self._outer_move(image, adv_image)
+            inner_image = self._inner_move(image, outer_image)
 
-    def _predict_for_free(self, image):
-        return self._predictor.predict_individual(image)
+            if self._adv_checker.successful(
+                    label, (yield from self._predict_steps(inner_image))
+            ):
+                return True, inner_image
+            return False, adv_image
+
+        candidate_size = min(self._candidate_size, self._budget - self.cost)
+        self._cost += candidate_size
+
+        adv_image_array, successful = yield from self._move_batch_steps(
+            image.unsqueeze(0), label.unsqueeze(0), adv_image.unsqueeze(0),
+            torch.tensor([candidate_size], device=image.device)
+        )
+        return successful.item(), adv_image_array.squeeze(0)
+
+    def _move_batch(
+            self, image_array, label_array, adv_image_array,
+            candidate_size_array, index
+    ):
+        # the valid candidates come image by image
+        owner = index.repeat_interleave(candidate_size_array)
+        return drive(
+            self._move_batch_steps(
+                image_array, label_array, adv_image_array,
+                candidate_size_array
+            ),
+            lambda image_array: self._predict_rows(image_array, owner)
+        )
+
+    def _move_batch_steps(
+            self, image_array, label_array, adv_image_array,
+            candidate_size_array
+    ):
+
+        # every image draws up to candidate_size_array[i] candidates,
+        # all of which are evaluated in a single predict_batch call;
+        # the successful candidate closest to the image is accepted
+
+        batch_size = image_array.shape[0]
+        candidate_size = self._candidate_size
+
+        repeated_image_array = image_array.repeat_interleave(
+            candidate_size, dim=0
+        )
+        inner_image_array = self._inner_move(
+            repeated_image_array,
+            self._outer_move_batch(
+                repeated_image_array,
+                adv_image_array.repeat_interleave(candidate_size, dim=0)
+            )
+        ).view(batch_size, candidate_size, *image_array.shape[1:])
+
+        valid = torch.arange(
+            candidate_size, device=image_array.device
+        ) < candidate_size_array.unsqueeze(1)
+
+        successful = torch.zeros_like(valid)
+        successful[valid] = self._adv_checker.successful_batch(
+            label_array.unsqueeze(1).expand(-1, candidate_size)[valid],
+            (yield inner_image_array[valid])
+        )
+
+        distance = (
+            inner_image_array - image_array.unsqueeze(1)
+        ).flatten(2).norm(dim=2).masked_fill(~successful, float('inf'))
+        best_image_array = inner_image_array[
+            torch.arange(batch_size, device=image_array.device),
+            distance.argmin(dim=1)
+        ]
+
+        moved = successful.any(dim=1)
+        return torch.where(
+            moved.view(-1, *[1] * (image_array.dim() - 1)),
+            best_image_array, adv_image_array
+        ), moved
 
     def _outer_move(self, image, adv_image):
 
@@ -116,13 +299,45 @@ class AbstractBoundaryAttacker(ABC):
         )
         return self._convention.project(result)
 
+    def _outer_move_batch(self, image_array, adv_image_array):
+
+        old_perturbation_norm = self._norm_batch(
+            adv_image_array - image_array, keepdim=True
+        )
+        random_move = (
+            self._outer_ratio
+            * old_perturbation_norm
+            * self._sampler.sample(image_array.shape[0])
+        )
+        perturbation = adv_image_array + random_move - image_array
+        result = image_array + (
+            old_perturbation_norm * perturbation
+            / self._norm_batch(perturbation, keepdim=True).clamp(min=1e-7)
+        )
+        return self._convention.project(result)
+
     def _inner_move(self, image, outer_image):
         return outer_image + self._inner_ratio * (image - outer_image)
 
+    @staticmethod
+    def _norm_batch(array, keepdim=False):
+        norm_array = array.flatten(1).norm(dim=1)
+        if keepdim:
+            norm_array = norm_array.view(-1, *[1] * (array.dim() - 1))
+        return norm_array
+
     @property
     def cost(self):
         return self._cost
 
+    @property
+    def cost_list(self):
+        return self._cost_array.tolist()
+
+    @property
+    def hit_list(self):
+        return self._hit_array.tolist()
+
 
 class InitializationException(Exception):
     pass
@@ -148,10 +363,11 @@ class BoundaryAttackerWithStopRadius(AbstractBoundaryAttacker):
             sampler: Sampler,
             adv_checker: AdvChecker,
             verbose=True,
+            candidate_size=1,
     ):
         super().__init__(predictor, outer_ratio, inner_ratio, budget,
                          convention, initializer, sampler, adv_checker,
-                         verbose)
+                         verbose, candidate_size)
         self._radius = radius
 
     def _ready_for_early_stop(self, image, label, adv_image):
@@ -1,88 +1,340 @@
 import math
+import torch
 
-from subattack.utils.predictors import ModulePredictor
+from subattack.utils.predictors import Predictor
+from subattack.utils.steps import drive
+from subattack.strategies.samplers import Sampler
+from subattack.strategies.conventions import Convention
 from subattack.strategies.adv_checkers import AdvChecker
 
 
 class OptAttacker:
 
+    # every model call evaluates a whole batch of candidate distances;
+    # batches are clamped to the remaining budget (fewer directions or
+    # fewer distances per direction), so the cost never exceeds it
+
+    # the attack and its searches are generators, which yield every batch
+    # of images they need predicted and receive the labels back, see
+    # utils.steps
+
     def __init__(
-            self, scale_ratio,
-            predictor: ModulePredictor,
+            self, predictor: Predictor,
+            scale_ratio, search_size, sample_size,
+            smoothing, step_size, tolerance, budget,
+            convention: Convention,
+            sampler: Sampler,
             adv_checker: AdvChecker,
+            stop_radius=None,
+            inf_bound=20,
+            verbose=True,
     ):
+        self._predictor = predictor
+
         self._scale_ratio = scale_ratio
-        self._inf_bound = 20
+        self._search_size = search_size
+        self._sample_size = sample_size
+        self._smoothing = smoothing
+        self._step_size = step_size
+        self._tolerance = tolerance
+        self._budget = budget
+        self._stop_radius = stop_radius
+        self._inf_bound = inf_bound
 
-        self._predictor = predictor
+        self._convention = convention
+        self._sampler = sampler
         self._adv_checker = adv_checker
 
+        self._verbose = verbose
+
         self._cost = 0
 
     def solve(self, image, label):
+        return drive(
+            self.solve_steps(image, label), self._predictor.predict_batch
+        )
+
+    def solve_steps(self, image, label):
         self._cost = 0
 
+        direction, distance = yield from self._initialize(image, label)
+        if math.isinf(distance):
+            return image
+
+        step_size = self._step_size
+        while True:
+
+            if self._verbose:
+                print(f'{self.cost:5d}, {distance:f}')
+
+            if self._ready_for_early_stop(distance):
+                break
+
+            if self.cost >= self._budget:
+                break
+
+            gradient = yield from self._estimate_gradient(
+                image, label, direction, distance
+            )
+            cand_direction = self._normalize(direction - step_size * gradient)
+            cand_distance = yield from self._estimate_directional_distance(
+                image, label, cand_direction, distance
+            )
+
+            if cand_distance < distance:
+                direction, distance = cand_direction, cand_distance
+            else:
+                step_size /= 2
+
+        if not self._constraint_satisfied(distance):
+            return image
+        return self._convention.project(image + distance * direction)
+
     @property
     def cost(self):
         return self._cost
 
-    def _estimate_gradient(self, image):
-        pass
+    def _ready_for_early_stop(self, distance):
+        return self._stop_radius is not None and distance <= self._stop_radius
 
-    def _estimate_directional_distance(self, image, label, direction, prior):
+    def _constraint_satisfied(self, distance):
+        return self._stop_radius is None or distance <= self._stop_radius
 
-        def successful(distance):
-            return self._get_attack_feedback(
-                image + distance * direction, label
+    def _initialize(self, image, label):
+        sample_size = min(self._sample_size, self._budget - self.cost)
+        direction_array = self._normalize_batch(
+            self._sampler.sample(sample_size)
+        )
+        distance_array = yield from self._estimate_directional_distance_batch(
+            image, label, direction_array,
+            torch.full(
+                (sample_size,), float(self._inf_bound), device=image.device
             )
+        )
+        best = distance_array.argmin()
+        return direction_array[best], distance_array[best].item()
+
+    def _estimate_gradient(self, image, label, direction, distance):
 
-        lower, upper = self._scale_search(
-            successful, prior, self._scale_ratio, self._inf_bound
+        sample_size = min(self._sample_size, self._budget - self.cost)
+        unit_vectors = self._sampler.sample(sample_size)
+        direction_array = self._normalize_batch(
+            direction.unsqueeze(0) + self._smoothing * unit_vectors
         )
-        return self._binary_search(successful, lower, upper,)
 
-    def _get_attack_feedback(self, image, label):
-        self._cost += 1
-        return self._get_attack_feedback_for_free(image, label)
+        distance_array = yield from self._estimate_directional_distance_batch(
+            image, label, direction_array,
+            torch.full((sample_size,), distance, device=image.device)
+        )
+
+        # directions out of the search bound carry no information
+        differences = torch.where(
+            torch.isinf(distance_array),
+            torch.zeros_like(distance_array),
+            distance_array - distance
+        ) / self._smoothing
 
-    def _get_attack_feedback_for_free(self, image, label):
-        return self._adv_checker.successful(
-            label, self._predictor.predict_individual(image)
+        return (
+            differences @ unit_vectors.view(sample_size, -1)
+        ).view(direction.shape) / sample_size
+
+    def _estimate_directional_distance(self, image, label, direction, prior):
+        distance_array = yield from self._estimate_directional_distance_batch(
+            image, label, direction.unsqueeze(0),
+            torch.tensor([prior], device=image.device)
         )
+        return distance_array.item()
 
-    @staticmethod
-    def _scale_search(successful, prior, scale_ratio, inf_bound=math.inf):
+    def _estimate_directional_distance_batch(
+            self, image, label, direction_array, prior_array
+    ):
+        lower_array, upper_array = yield from self._scale_search_batch(
+            image, label, direction_array, prior_array
+        )
+        return (yield from self._kary_search_batch(
+            image, label, direction_array, lower_array, upper_array
+        ))
+
+    def _get_attack_feedback_batch(
+            self, image, label, direction_array, distance_array
+    ):
+        # distance_array: [num_directions, num_distances]
+        image_array = self._convention.project(
+            image + distance_array.view(*distance_array.shape, 1, 1, 1)
+            * direction_array.unsqueeze(1)
+        )
+        self._cost += distance_array.numel()
+        return self._adv_checker.successful_batch(
+            label.expand(distance_array.numel()),
+            (yield image_array.flatten(0, 1))
+        ).view(distance_array.shape)
+
+    def _scale_search_batch(
+            self, image, label, direction_array, prior_array
+    ):
 
         # successful(0.) must be False
+        # successful directions are shrunk until they fail, the others are
+        # grown until they succeed, search_size distances per model call
 
-        upper = prior
-        lower = prior
+        lower_array = prior_array.clone()
+        upper_array = prior_array.clone()
 
-        if successful(prior):
-            while successful(lower):
-                lower *= (1 - scale_ratio)
-        else:
-            while not successful(upper):
-                if upper > inf_bound:
-                    return lower, math.inf
-                upper *= (1 + scale_ratio)
+        if self.cost >= self._budget:
+            upper_array[:] = math.inf
+            return lower_array, upper_array
 
-        return lower, upper
+        shrinking = (yield from self._get_attack_feedback_batch(
+            image, label, direction_array, prior_array.unsqueeze(1)
+        )).squeeze(1)
+        ratio_array = torch.where(
+            shrinking,
+            torch.full_like(prior_array, 1 - self._scale_ratio),
+            torch.full_like(prior_array, 1 + self._scale_ratio)
+        )
+        exponents = torch.arange(
+            1, self._search_size + 1, device=prior_array.device
+        )
 
-    @staticmethod
-    def _binary_search(successful, lower, upper, abs_tol=1e-9):
+        pending = torch.ones_like(shrinking)
+        while pending.any():
+
+            index = pending.nonzero().squeeze(1)
+
+            if self.cost >= self._budget:
+                # shrinking directions keep their last successful distance
+                lower_array[index] = torch.where(
+                    shrinking[index], upper_array[index], lower_array[index]
+                )
+                upper_array[index] = torch.where(
+                    shrinking[index], upper_array[index],
+                    torch.full_like(upper_array[index], math.inf)
+                )
+                break
+
+            index, width = self._clamp_search(index)
+            start_array = torch.where(
+                shrinking[index], lower_array[index], upper_array[index]
+            )
+            distance_array = (
+                start_array.unsqueeze(1)
+                * ratio_array[index].unsqueeze(1) ** exponents[:width]
+            )
+            flipped = (yield from self._get_attack_feedback_batch(
+                image, label, direction_array[index], distance_array
+            )) != shrinking[index].unsqueeze(1)
+
+            found = flipped.any(dim=1)
+            first = flipped.int().argmax(dim=1, keepdim=True)
+            flip_distance_array = distance_array.gather(1, first).squeeze(1)
+            previous_distance_array = torch.where(
+                first.squeeze(1) > 0,
+                distance_array.gather(1, (first - 1).clamp(min=0)).squeeze(1),
+                start_array
+            )
+            last_distance_array = distance_array[:, -1]
+
+            # shrinking: lower fails and upper succeeds
+            # growing: the same, with the roles of the ends swapped
+            lower_array[index] = torch.where(
+                found,
+                torch.where(
+                    shrinking[index],
+                    flip_distance_array, previous_distance_array
+                ),
+                torch.where(
+                    shrinking[index],
+                    last_distance_array, lower_array[index]
+                )
+            )
+            upper_array[index] = torch.where(
+                found,
+                torch.where(
+                    shrinking[index],
+                    previous_distance_array, flip_distance_array
+                ),
+                last_distance_array
+            )
+
+            out_of_bound = (
+                ~found & ~shrinking[index]
+                & (last_distance_array > self._inf_bound)
+            )
+            upper_array[index[out_of_bound]] = math.inf
+
+            pending[index[found | out_of_bound]] = False
+
+        return lower_array, upper_array
+
+    def _kary_search_batch(
+            self, image, label, direction_array, lower_array, upper_array
+    ):
 
         # successful(lower) must be False
         # successful(upper) must be True
 
-        if math.isinf(upper):
-            return upper
+        lower_array = lower_array.clone()
+        upper_array = upper_array.clone()
 
-        while not math.isclose(lower, upper, abs_tol=abs_tol):
-            mid = (lower + upper) / 2
-            if successful(mid):
-                upper = mid
-            else:
-                lower = mid
+        while self.cost < self._budget:
+
+            pending = (
+                torch.isfinite(upper_array)
+                & (upper_array - lower_array > self._tolerance)
+            )
+            if not pending.any():
+                break
+
+            index, width = self._clamp_search(pending.nonzero().squeeze(1))
+            fractions = torch.arange(
+                1, width + 1, device=lower_array.device
+            ) / (width + 1)
+
+            distance_array = (
+                lower_array[index].unsqueeze(1)
+                + (upper_array[index] - lower_array[index]).unsqueeze(1)
+                * fractions
+            )
+            successful = yield from self._get_attack_feedback_batch(
+                image, label, direction_array[index], distance_array
+            )
 
-        return upper
+            found = successful.any(dim=1)
+            first = successful.int().argmax(dim=1, keepdim=True)
+
+            upper_array[index[found]] = distance_array.gather(
+                1, first
+            ).squeeze(1)[found]
+            lower_array[index] = torch.where(
+                found,
+                torch.where(
+                    first.squeeze(1) > 0,
+                    distance_array.gather(
+                        1, (first - 1).clamp(min=0)
+                    ).squeeze(1),
+                    lower_array[index]
+                ),
+                distance_array[:, -1]
+            )
+
+        return upper_array
+
+    def _clamp_search(self, index):
+        # the pending directions searched by the next batch and the number
+        # of distances tried along each, within the remaining budget; the
+        # directions left out are handled as out of budget
+        remaining = self._budget - self.cost
+        width = min(self._search_size, remaining // index.numel())
+        if width == 0:
+            return index[:remaining], 1
+        return index, width
+
+    @staticmethod
+    def _normalize(vector, epsilon=1e-7):
+        return vector / vector.norm().clamp(min=epsilon)
+
+    @staticmethod
+    def _normalize_batch(vector_array, epsilon=1e-7):
+        return vector_array / vector_array.flatten(1).norm(dim=1).clamp(
+            min=epsilon
+        ).view(-1, *[1] * (vector_array.dim() - 1))
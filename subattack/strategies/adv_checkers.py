@@ -7,18 +7,28 @@ class AdvChecker(ABC):
     def successful(self, label, pred_label):
         pass
 
+    @abstractmethod
+    def successful_batch(self, label_array, pred_label_array):
+        pass
+
 
 class UntargetedAdvChecker(AdvChecker):
 
     def successful(self, label, pred_label):
         return bool((label != pred_label).item())
 
+    def successful_batch(self, label_array, pred_label_array):
+        return label_array != pred_label_array
+
 
 class TargetedAdvChecker(AdvChecker):
 
     def successful(self, label, pred_label):
         return bool((label == pred_label).item())
 
+    def successful_batch(self, label_array, pred_label_array):
+        return label_array == pred_label_array
+
 
 class AdvCheckerFactory:
 
@@ -16,7 +16,18 @@ class GradientEstimator(ABC):
         pass
 
 
-class RgfEstimator(GradientEstimator):
+class BatchGradientEstimator(GradientEstimator):
+
+    @abstractmethod
+    def probe_batch(self, image_array):
+        pass
+
+    @abstractmethod
+    def combine_batch(self, loss_array, probe_loss_array, directions):
+        pass
+
+
+class RgfEstimator(BatchGradientEstimator):
 
     def __init__(
         self,
@@ -50,6 +61,32 @@ class RgfEstimator(GradientEstimator):
 
         return gradient, unit_vectors.shape[0]
 
+    def probe_batch(self, image_array):
+
+        unit_vectors = self._sampler.sample(
+            image_array.shape[0] * self._sample_size
+        ).view(image_array.shape[0], self._sample_size, *image_array.shape[1:])
+
+        probe_array = image_array.unsqueeze(1) + unit_vectors * self._change
+        return probe_array, unit_vectors
+
+    def combine_batch(self, loss_array, probe_loss_array, unit_vectors):
+
+        batch_size, sample_size = probe_loss_array.shape
+
+        gradient_array = torch.bmm(
+            (
+                (probe_loss_array - loss_array.unsqueeze(1)) / self._change
+            ).unsqueeze(1),
+            unit_vectors.view(batch_size, sample_size, -1)
+        ).squeeze(1) / sample_size
+
+        gradient_array = gradient_array.view(
+            batch_size, *unit_vectors.shape[2:]
+        )
+
+        return gradient_array, sample_size
+
 
 class PriorEstimator(GradientEstimator):
 
@@ -57,9 +57,14 @@ class InitializerWithOutputDevice(InitializerDecorator):
 
 class InitializerFactory:
 
+    def needs_basis(self, name):
+        return name != 'zero' and SamplerFactory().needs_basis(name)
+
     def create_initializer(
             self, name, radius=None,
-            shape=None, basis=None, device='cpu'
+            shape=None, basis=None, device='cpu',
+            band_start=0, band_end=None, resolution=None,
+            block_size=None, num_threads=1,
     ):
         if name == 'zero':
             assert shape is not None
@@ -68,7 +73,10 @@ class InitializerFactory:
             assert radius is not None
             sampler_factory = SamplerFactory()
             sampler = sampler_factory.create_sampler(
-                name=name, shape=shape, basis=basis, device=device
+                name=name, shape=shape, basis=basis, device=device,
+                band_start=band_start, band_end=band_end,
+                resolution=resolution,
+                block_size=block_size, num_threads=num_threads
             )
             return InitializerBySampling(radius, sampler)
 
@@ -77,9 +85,13 @@ class InitializerWithOutputDeviceFactory(InitializerFactory):
 
     def create_initializer(
             self, name, radius=None,
-            shape=None, basis=None, device='cpu', output_device='cpu'
+            shape=None, basis=None, device='cpu',
+            band_start=0, band_end=None, resolution=None,
+            block_size=None, num_threads=1,
+            output_device='cpu'
     ):
         initializer = super().create_initializer(
-            name, radius, shape, basis, device
+            name, radius, shape, basis, device,
+            band_start, band_end, resolution, block_size, num_threads
         )
         return InitializerWithOutputDevice(initializer, output_device)
@@ -5,9 +5,12 @@ from abc import ABC, abstractmethod
 class LossEvaluator(ABC):
 
     @abstractmethod
-    def compute_batch(self, model, image_array, label_array):
+    def compute_from_logits(self, logits, label_array):
         pass
 
+    def compute_batch(self, model, image_array, label_array):
+        return self.compute_from_logits(model(image_array), label_array)
+
     def compute_individual(self, model, image, label):
         return self.compute_batch(
             model, image.unsqueeze(0), label.unsqueeze(0)
@@ -18,8 +21,8 @@ class CrossEntropyLossEvaluator(LossEvaluator):
     def __init__(self):
         self._criterion = nn.CrossEntropyLoss(reduction='none')
 
-    def compute_batch(self, model, image_array, label_array):
-        return self._criterion(model(image_array), label_array)
+    def compute_from_logits(self, logits, label_array):
+        return self._criterion(logits, label_array)
 
 
 class LossEvaluatorFactory:
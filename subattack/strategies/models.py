@@ -1,5 +1,7 @@
+import copy
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 import torchvision
 
@@ -22,9 +24,126 @@ class NormalizingHead(nn.Module):
         return 'mean={}, std={}'.format(self._mean, self._std)
 
 
+class FoldedConv2d(nn.Module):
+    """A convolution with a NormalizingHead folded into its weights
+
+    conv((x - mean) / std) = conv'(x) + offset, where conv' has the weights
+    divided by std and no bias. Since the normalized input is zero padded,
+    the offset depends on the position near the borders, so it is kept as
+    a map precomputed for input_shape.
+    """
+
+    def __init__(self, conv, mean, std, input_shape):
+        super().__init__()
+        device = conv.weight.device
+        std = torch.tensor(std, device=device).view(1, -1, 1, 1)
+        mean = torch.tensor(mean, device=device).view(-1, 1, 1)
+
+        # folded in float32 whatever the dtype of the convolution
+        weight = conv.weight.float() / std
+        offset = -F.conv2d(
+            mean.expand(input_shape).unsqueeze(0), weight, None,
+            conv.stride, conv.padding, conv.dilation, conv.groups
+        )[0]
+        if conv.bias is not None:
+            offset += conv.bias.float().view(-1, 1, 1)
+
+        self._conv = nn.Conv2d(
+            conv.in_channels, conv.out_channels, conv.kernel_size,
+            conv.stride, conv.padding, conv.dilation, conv.groups,
+            bias=False
+        ).to(device=device, dtype=conv.weight.dtype)
+        self._conv.weight.data = weight.to(conv.weight.dtype)
+        self.register_buffer('_offset', offset.to(conv.weight.dtype))
+
+    def forward(self, input):
+        return self._conv(input) + self._offset
+
+
+class OptimizedModel(nn.Module):
+
+    # channels_last inputs under inference_mode; the logits are cloned out
+    # of inference mode, so callers may keep using them as usual tensors
+
+    def __init__(self, module):
+        super().__init__()
+        self._module = module
+
+    def forward(self, input):
+        with torch.inference_mode():
+            output = self._module(
+                input.contiguous(memory_format=torch.channels_last)
+            )
+        return output.clone()
+
+
+class CastOutput(nn.Module):
+    """Runs a module as it is and casts its output to dtype"""
+
+    def __init__(self, module, dtype):
+        super().__init__()
+        self._module = module
+        self._dtype = dtype
+
+    def forward(self, input):
+        return self._module(input).to(self._dtype)
+
+
+class MixedPrecisionModel(nn.Module):
+    """Runs a reduced-precision copy of a model first
+
+    The inputs whose top-2 logit margin falls below margin are run again
+    through the float32 model, so the predicted labels stay those of the
+    float32 model as long as the reduced logits are off by less than
+    margin / 2, while most queries take the fast path. The reduced copy
+    takes float32 inputs, which reach its normalization and first
+    convolution unquantized. Its logits are still far too coarse for the
+    loss differences of score-based gradient probes, so it is meant for
+    label predictors only.
+    """
+
+    def __init__(self, module, reduced_module, margin):
+        super().__init__()
+        self._module = module
+        self._reduced_module = reduced_module
+        self._margin = margin
+
+        self._query_count = 0
+        self._fallback_count = 0
+
+    def forward(self, input):
+        output = self._reduced_module(input).float()
+
+        top_2 = output.topk(2, dim=1).values
+        fallback = (top_2[:, 0] - top_2[:, 1]) < self._margin
+        if fallback.any():
+            output[fallback] = self._module(input[fallback])
+
+        self._query_count += input.shape[0]
+        self._fallback_count += fallback.sum().item()
+        return output
+
+    @property
+    def query_count(self):
+        return self._query_count
+
+    @property
+    def fallback_count(self):
+        return self._fallback_count
+
+    @property
+    def fallback_rate(self):
+        return (
+            self._fallback_count / self._query_count
+            if self._query_count else 0.
+        )
+
+
 class ModelFactory:
 
-    def create_model(self, name, device):
+    def create_model(self, name, device, optimize='none',
+                     input_shape=(3, 224, 224), tolerance=1e-3,
+                     precision='float32', margin=0.5):
         model = nn.Sequential(
             NormalizingHead(),
             getattr(torchvision.models, name)(pretrained=True)
@@ -32,4 +151,91 @@ class ModelFactory:
         model.eval()
         for p in model.parameters():
             p.requires_grad = False
-        return model.to(device)
+        model = model.to(device)
+
+        if precision == 'float32':
+            return self._build(
+                model, optimize, input_shape, device, tolerance
+            )
+        elif precision == 'bfloat16':
+            # the input, the normalization and the first convolution stay
+            # in float32, since bfloat16 pixels would quantize away small
+            # perturbations; the reduced copy is only checked against its
+            # own eager version, at bfloat16 resolution
+            reduced_model = copy.deepcopy(model).to(torch.bfloat16)
+            self._replace_first_conv(
+                reduced_model[1],
+                lambda conv: CastOutput(conv.float(), torch.bfloat16)
+            )
+            return MixedPrecisionModel(
+                self._build(model, optimize, input_shape, device, tolerance),
+                self._build(
+                    reduced_model, optimize, input_shape, device, 2 ** -5
+                ),
+                margin
+            )
+        else:
+            raise Exception('unsupported model precision')
+
+    def _build(self, model, optimize, input_shape, device, tolerance):
+        if optimize == 'none':
+            return model
+        elif optimize in ('fold', 'script', 'compile'):
+            optimized_model = self._optimize(
+                model, optimize, input_shape, device
+            )
+        else:
+            raise Exception('unsupported model optimization')
+
+        self._check(model, optimized_model, input_shape, device, tolerance)
+        return optimized_model
+
+    def _optimize(self, model, optimize, input_shape, device):
+        # the eager model is kept untouched as the reference of _check
+        head, body = model[0], copy.deepcopy(model[1])
+
+        # the head is folded into the first convolution, which must be the
+        # first layer the input goes through
+        self._replace_first_conv(body, lambda conv: FoldedConv2d(
+            conv, head._mean, head._std, input_shape
+        ))
+        body = body.to(memory_format=torch.channels_last)
+
+        if optimize == 'script':
+            example = torch.rand(
+                1, *input_shape, device=device,
+                dtype=next(body.parameters()).dtype
+            ).contiguous(memory_format=torch.channels_last)
+            with torch.inference_mode():
+                body = torch.jit.freeze(torch.jit.trace(body, example))
+        elif optimize == 'compile':
+            body = torch.compile(body)
+
+        return OptimizedModel(body)
+
+    @staticmethod
+    def _replace_first_conv(body, create):
+        name, conv = next(
+            (name, module) for name, module in body.named_modules()
+            if isinstance(module, nn.Conv2d)
+        )
+        parent_name, _, attribute = name.rpartition('.')
+        parent = body.get_submodule(parent_name) if parent_name else body
+        setattr(parent, attribute, create(conv))
+
+    @staticmethod
+    def _check(model, optimized_model, input_shape, device, tolerance):
+        input = torch.rand(
+            2, *input_shape, device=device,
+            dtype=next(model.parameters()).dtype
+        )
+        with torch.no_grad():
+            expected = model(input).float()
+        actual = optimized_model(input).float()
+        error = (actual - expected).abs().max().item()
+        if error > tolerance * expected.abs().max().item():
+            raise Exception(
+                'optimized model deviates from the eager model by {}'.format(
+                    error
+                )
+            )
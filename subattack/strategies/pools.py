@@ -1,4 +1,7 @@
 import torch
+import hashlib
+import numpy as np
+import torch.nn.functional as F
 from abc import ABC, abstractmethod
 
 
@@ -16,47 +19,263 @@ class PoolFetcher(ABC):
 
 class RandomPoolWithLabelsFetcher(PoolFetcher):
 
+    # the pool is filled in place into a buffer allocated once, optionally
+    # as uint8 (4x smaller) and optionally backed by a memory-mapped file;
+    # consumers turn it into floats block by block with decode_pool_block
+
+    def __init__(self, loader, max_size, device, dtype=torch.float32,
+                 path=None):
+        super().__init__(loader, max_size, device)
+        self._dtype = dtype
+        self._path = path
+
     def fetch(self):
         count = 0
-        image_collection = []
-        label_collection = []
+        image_pool = None
+        label_pool = None
         for image_array, label_array in self._loader:
 
-            image_array = image_array.to(self._device)
-            label_array = label_array.to(self._device)
-
-            arrival_size = image_array.shape[0]
-            if arrival_size + count > self._max_size:
-                image_collection.append(
-                    image_array[: self._max_size-count]
-                )
-                label_collection.append(
-                    label_array[: self._max_size-count]
+            if image_pool is None:
+                image_pool = self._allocate(image_array.shape[1:])
+                label_pool = torch.empty(
+                    self._max_size, dtype=label_array.dtype,
+                    device=image_pool.device
                 )
+
+            arrival_size = min(image_array.shape[0], self._max_size - count)
+            image_pool[count:count+arrival_size] = encode_pool_block(
+                image_array[:arrival_size].to(image_pool.device), self._dtype
+            )
+            label_pool[count:count+arrival_size] = (
+                label_array[:arrival_size].to(label_pool.device)
+            )
+
+            count += arrival_size
+            if count >= self._max_size:
                 break
-            else:
-                image_collection.append(image_array)
-                label_collection.append(label_array)
-                count += arrival_size
-        return torch.cat(image_collection), torch.cat(label_collection)
+
+        return (
+            image_pool[:count].to(self._device),
+            label_pool[:count].to(self._device)
+        )
+
+    def _allocate(self, shape, size=None):
+        size = self._max_size if size is None else size
+        if self._path is None:
+            return torch.empty(
+                size, *shape, dtype=self._dtype, device=self._device
+            )
+        return torch.from_numpy(np.lib.format.open_memmap(
+            self._path, mode='w+',
+            dtype=torch.empty(0, dtype=self._dtype).numpy().dtype,
+            shape=(size, *shape)
+        ))
+
+
+class ReservoirPoolWithLabelsFetcher(RandomPoolWithLabelsFetcher):
+
+    # a uniform sample of max_size images of the whole loader in a single
+    # pass, keeping only max_size images in memory at any time
+
+    def __init__(self, loader, max_size, device, dtype=torch.float32,
+                 path=None, deduplicator=None):
+        super().__init__(loader, max_size, device, dtype, path)
+        self._deduplicator = deduplicator
+
+    def fetch(self):
+        image_pool = None
+        label_pool = None
+        for image_array, label_array in self._loader:
+
+            if image_pool is None:
+                image_pool = self._allocate(image_array.shape[1:])
+                label_pool = torch.empty(
+                    image_pool.shape[0], dtype=label_array.dtype,
+                    device=image_pool.device
+                )
+                self._reset()
+
+            for image, label in zip(image_array, label_array):
+                if (self._deduplicator is not None and
+                        self._deduplicator.duplicated(image)):
+                    continue
+
+                slot = self._choose_slot(label.item())
+                if slot is not None:
+                    image_pool[slot] = encode_pool_block(
+                        image.to(image_pool.device), self._dtype
+                    )
+                    label_pool[slot] = label
+
+        # the filled slots are always the first ones, so the pool is a
+        # view of the buffer and a memory-mapped one stays mapped
+        count = self._get_filled_size()
+        return (
+            image_pool[:count].to(self._device),
+            label_pool[:count].to(self._device)
+        )
+
+    def _reset(self):
+        self._seen_size = 0
+
+    def _choose_slot(self, label):
+        slot = self._draw_slot(self._seen_size, self._max_size)
+        self._seen_size += 1
+        return slot
+
+    def _get_filled_size(self):
+        return min(self._seen_size, self._max_size)
+
+    @staticmethod
+    def _draw_slot(seen_size, capacity):
+        # algorithm R: the i-th item replaces a uniform slot with
+        # probability capacity / (i + 1)
+        if seen_size < capacity:
+            return seen_size
+        slot = torch.randint(0, seen_size + 1, (1,)).item()
+        return slot if slot < capacity else None
+
+
+class StratifiedPoolWithLabelsFetcher(ReservoirPoolWithLabelsFetcher):
+
+    # one reservoir of ceil(max_size / num_classes) ranks per class, so the
+    # pool stays balanced even if the loader is not. The reservoirs share
+    # the max_size slots of the buffer: once it is full, a new (rank,
+    # label) takes the slot of the largest one stored, or is dropped if it
+    # is the largest itself; the pool keeps the max_size smallest of all
+    # filled (rank, label), i.e. the images of all classes rank by rank
+
+    def __init__(self, loader, max_size, device, dtype=torch.float32,
+                 path=None, deduplicator=None, num_classes=1000):
+        super().__init__(loader, max_size, device, dtype, path, deduplicator)
+        self._num_classes = num_classes
+        self._capacity = -(-max_size // num_classes)
+
+    def _reset(self):
+        self._seen_size_list = [0] * self._num_classes
+        self._slot_dict = {}
+
+    def _choose_slot(self, label):
+        seen_size = self._seen_size_list[label]
+        rank = self._draw_slot(seen_size, self._capacity)
+        self._seen_size_list[label] += 1
+
+        key = (rank, label)
+        if rank is None or key in self._slot_dict:
+            return self._slot_dict.get(key)
+        if rank < seen_size:
+            # a replacement in a rank which was dropped
+            return None
+
+        if len(self._slot_dict) < self._max_size:
+            slot = len(self._slot_dict)
+        else:
+            largest = max(self._slot_dict)
+            if key > largest:
+                return None
+            slot = self._slot_dict.pop(largest)
+        self._slot_dict[key] = slot
+        return slot
+
+    def _get_filled_size(self):
+        return len(self._slot_dict)
+
+
+class DownsampledHashDeduplicator:
+
+    # images are near duplicates when they agree after average pooling to
+    # size x size and quantizing to levels values per pixel
+
+    def __init__(self, size=8, levels=16):
+        self._size = size
+        self._levels = levels
+        self._digest_set = set()
+
+    def duplicated(self, image):
+        small = F.adaptive_avg_pool2d(
+            image.unsqueeze(0).float(), self._size
+        )
+        key = (small * (self._levels - 1)).round().to(torch.uint8)
+        digest = hashlib.blake2b(
+            key.cpu().numpy().tobytes(), digest_size=16
+        ).digest()
+
+        if digest in self._digest_set:
+            return True
+        self._digest_set.add(digest)
+        return False
 
 
 class RandomPoolFetcher(PoolFetcher):
-    def __init__(self, loader, max_size, device):
+    def __init__(self, loader, max_size, device, dtype=torch.float32,
+                 path=None):
         self._random_pool_with_labels_fetcher = RandomPoolWithLabelsFetcher(
-            loader, max_size, device)
+            loader, max_size, device, dtype, path)
 
     def fetch(self):
         result, _ = self._random_pool_with_labels_fetcher.fetch()
         return result
 
 
+class PoolWithoutLabelsFetcher(PoolFetcher):
+
+    def __init__(self, pool_with_labels_fetcher):
+        self._pool_with_labels_fetcher = pool_with_labels_fetcher
+
+    def fetch(self):
+        result, _ = self._pool_with_labels_fetcher.fetch()
+        return result
+
+
+def encode_pool_block(image_array, dtype):
+    if dtype == torch.uint8:
+        return (image_array * 255).round().to(torch.uint8)
+    return image_array.to(dtype)
+
+
+def decode_pool_block(block, dtype=torch.float32):
+    if block.dtype == torch.uint8:
+        return block.to(dtype) / 255
+    return block.to(dtype)
+
+
 class PoolFetcherFactory:
 
-    def create_pool_fetcher(self, name, loader, max_size, device):
+    def create_pool_fetcher(self, name, loader, max_size, device,
+                            storage='float32', path=None,
+                            deduplicate=False, num_classes=1000):
+        if storage == 'float32':
+            dtype = torch.float32
+        elif storage == 'uint8':
+            dtype = torch.uint8
+        else:
+            raise Exception('unsupported pool storage')
+
+        deduplicator = DownsampledHashDeduplicator() if deduplicate else None
+
         if name == 'random':
-            return RandomPoolFetcher(loader, max_size, device)
+            return RandomPoolFetcher(loader, max_size, device, dtype, path)
         elif name == 'random_with_labels':
-            return RandomPoolWithLabelsFetcher(loader, max_size, device)
+            return RandomPoolWithLabelsFetcher(
+                loader, max_size, device, dtype, path
+            )
+        elif name == 'reservoir':
+            return PoolWithoutLabelsFetcher(ReservoirPoolWithLabelsFetcher(
+                loader, max_size, device, dtype, path, deduplicator
+            ))
+        elif name == 'reservoir_with_labels':
+            return ReservoirPoolWithLabelsFetcher(
+                loader, max_size, device, dtype, path, deduplicator
+            )
+        elif name == 'stratified':
+            return PoolWithoutLabelsFetcher(StratifiedPoolWithLabelsFetcher(
+                loader, max_size, device, dtype, path, deduplicator,
+                num_classes
+            ))
+        elif name == 'stratified_with_labels':
+            return StratifiedPoolWithLabelsFetcher(
+                loader, max_size, device, dtype, path, deduplicator,
+                num_classes
+            )
         else:
             raise Exception('unsupported pool fetcher')
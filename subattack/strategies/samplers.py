@@ -1,5 +1,10 @@
+import os
+import math
 import torch
+import torch.nn.functional as F
 from abc import ABC, abstractmethod
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 
 class Sampler(ABC):
@@ -19,9 +24,9 @@ class SphereSampler(Sampler):
         self._shape = shape
         self._epsilon = epsilon
 
-    def sample(self, sample_size):
+    def sample(self, sample_size, generator=None):
         gaussian_noise = torch.randn(
-            sample_size, self._shape.numel()
+            sample_size, self._shape.numel(), generator=generator
         ).to(self._device)
 
         return (
@@ -37,38 +42,348 @@ class BallSampler(SphereSampler):
         n_dim = shape.numel()
         self._ratio = torch.rand((1,)).item() ** (1/n_dim)
 
-    def sample(self, sample_size):
-        return self._ratio * super().sample(sample_size)
+    def sample(self, sample_size, generator=None):
+        return self._ratio * super().sample(sample_size, generator)
 
 
 class SubspaceSphereSampler(Sampler):
 
-    def __init__(self, basis, device, epsilon=1e-7):
+    # with block_size set, expand runs as a blocked matmul: every thread
+    # owns column_block_size output columns and accumulates them over
+    # block_size basis rows at a time, so a memory-mapped basis is read
+    # tile by tile, once per call, and never has to fit in memory.
+    # A bfloat16 or float16 basis is multiplied in its own dtype, the GEMM
+    # accumulating in float32; an int8 basis (per-row scales folded into
+    # the weights) always takes the blocked path, every tile converted
+    # exactly to bfloat16 right before its product. Blocked partial
+    # products are summed in float32
+
+    def __init__(self, basis, device, epsilon=1e-7,
+                 block_size=None, column_block_size=8192, num_threads=1,
+                 precision='float32'):
         super().__init__(device)
-        self._basis = basis.to(device)
+        self._basis, self._scales = _reduce_precision(
+            basis.to(device), precision
+        )
         self._epsilon = epsilon
+        self._block_size = (
+            128 if block_size is None and precision == 'int8'
+            else block_size
+        )
+        self._tile_dtype = (
+            torch.bfloat16 if precision == 'int8' else self._basis.dtype
+        )
+        self._column_block_size = column_block_size
+        self._num_threads = num_threads
 
-    def sample(self, sample_size):
+    def sample(self, sample_size, generator=None):
+        return self.expand(self.sample_weights(sample_size, generator))
+
+    def sample_weights(self, sample_size, generator=None):
         gaussian_noise = torch.randn(
-            sample_size, self._basis.shape[0]
+            sample_size, self._basis.shape[0], generator=generator
         ).to(self._device)
 
-        weights = gaussian_noise / gaussian_noise.norm(
+        return gaussian_noise / gaussian_noise.norm(
             dim=1, keepdim=True).clamp(self._epsilon)
-        return (
-            weights @ self._basis.view(self._basis.shape[0], -1)
-        ).view(sample_size, *self._basis.shape[1:])
+
+    def expand(self, weights):
+        # maps [N, k] coefficients to [N, *shape] pixel space vectors
+        basis = self._basis.view(self._basis.shape[0], -1)
+        if self._block_size is None:
+            result = (weights.to(basis.dtype) @ basis).to(weights.dtype)
+        else:
+            result = self._expand_blocked(weights, basis)
+        return result.view(weights.shape[0], *self._basis.shape[1:])
+
+    def check_precision(self, basis, sample_size=16, check_size=512):
+        """Compares the stored basis with the float32 basis it was made of
+
+        Reports the largest deviation of the gram matrix of check_size
+        random stored rows from the identity, next to the same for the
+        float32 rows, and the relative l2 error of sample_size directions.
+        """
+        basis = basis.to(self._device).view(basis.shape[0], -1)
+        stored = self._basis.view(self._basis.shape[0], -1)
+
+        rows = torch.randperm(basis.shape[0])[:check_size].to(self._device)
+        identity = torch.eye(rows.shape[0], device=self._device)
+        reference_rows = basis[rows].float()
+        stored_rows = stored[rows].float()
+        if self._scales is not None:
+            stored_rows = stored_rows * self._scales[rows].unsqueeze(1)
+
+        weights = self.sample_weights(sample_size)
+        reference = weights @ basis.float()
+        error = (
+            self.expand(weights).view(sample_size, -1) - reference
+        ).norm(dim=1) / reference.norm(dim=1).clamp(self._epsilon)
+
+        return OrderedDict([
+            ('float32 orthonormality error', (
+                reference_rows @ reference_rows.t() - identity
+            ).abs().max().item()),
+            ('orthonormality error', (
+                stored_rows @ stored_rows.t() - identity
+            ).abs().max().item()),
+            ('mean direction error', error.mean().item()),
+            ('max direction error', error.max().item()),
+        ])
+
+    def _expand_blocked(self, weights, basis):
+        result = torch.zeros(
+            weights.shape[0], basis.shape[1],
+            dtype=torch.float32, device=weights.device
+        )
+        weights = weights.float()
+        if self._scales is not None:
+            weights = weights * self._scales
+        weights = weights.to(self._tile_dtype)
+
+        def expand_columns(start):
+            end = min(start + self._column_block_size, basis.shape[1])
+            for row_start in range(0, basis.shape[0], self._block_size):
+                row_end = row_start + self._block_size
+                tile = basis[row_start:row_end, start:end].to(
+                    self._tile_dtype
+                )
+                if tile.dtype == torch.float32:
+                    result[:, start:end].addmm_(
+                        weights[:, row_start:row_end], tile
+                    )
+                else:
+                    result[:, start:end] += (
+                        weights[:, row_start:row_end] @ tile
+                    )
+
+        column_starts = range(0, basis.shape[1], self._column_block_size)
+        if self._num_threads <= 1:
+            for start in column_starts:
+                expand_columns(start)
+        else:
+            with ThreadPoolExecutor(self._num_threads) as executor:
+                list(executor.map(expand_columns, column_starts))
+        return result
 
 
 class SubspaceBallSampler(SubspaceSphereSampler):
 
-    def __init__(self, basis, device, epsilon=1e-7):
-        super().__init__(basis, device, epsilon)
+    def __init__(self, basis, device, epsilon=1e-7,
+                 block_size=None, column_block_size=8192, num_threads=1,
+                 precision='float32'):
+        super().__init__(
+            basis, device, epsilon,
+            block_size, column_block_size, num_threads, precision
+        )
         n_dim = basis.shape[0]
         self._ratio = torch.rand((1,)).item() ** (1/n_dim)
 
-    def sample(self, sample_size):
-        return self._ratio * super().sample(sample_size)
+    def sample_weights(self, sample_size, generator=None):
+        return self._ratio * super().sample_weights(sample_size, generator)
+
+
+class OrthogonalSphereSampler(SphereSampler):
+
+    # the directions of one call are orthonormal (in blocks of at most D)
+    # instead of independent, which lowers the variance of RGF for the same
+    # number of queries. With rotation_size set, one random orthonormal
+    # frame of rotation_size directions is drawn once and every call takes
+    # random rows of it with random signs, instead of running a QR
+
+    def __init__(self, shape, device, rotation_size=None, epsilon=1e-7):
+        super().__init__(shape, device, epsilon)
+        self._rotation = _draw_rotation(rotation_size, shape.numel())
+
+    def sample(self, sample_size, generator=None):
+        return _draw_orthonormal_rows(
+            sample_size, self._shape.numel(), generator, self._rotation
+        ).to(self._device).view(-1, *self._shape)
+
+
+class OrthogonalSubspaceSphereSampler(SubspaceSphereSampler):
+
+    # the same in coefficient space; with an orthonormal basis, the
+    # directions are orthonormal in pixel space as well
+
+    def __init__(self, basis, device, rotation_size=None, epsilon=1e-7,
+                 block_size=None, column_block_size=8192, num_threads=1,
+                 precision='float32'):
+        super().__init__(
+            basis, device, epsilon,
+            block_size, column_block_size, num_threads, precision
+        )
+        self._rotation = _draw_rotation(rotation_size, basis.shape[0])
+
+    def sample_weights(self, sample_size, generator=None):
+        return _draw_orthonormal_rows(
+            sample_size, self._basis.shape[0], generator, self._rotation
+        ).to(self._device)
+
+
+def _draw_rotation(rotation_size, dimension):
+    if rotation_size is None:
+        return None
+    return _draw_orthonormal_rows(min(rotation_size, dimension), dimension)
+
+
+def _draw_orthonormal_rows(sample_size, dimension, generator=None,
+                           rotation=None):
+    if rotation is None:
+        # one batched QR of gaussian [dimension, block_size] matrices; the
+        # signs of diag(R) are moved into Q to make it uniformly distributed
+        block_size = min(sample_size, dimension)
+        q, r = torch.linalg.qr(torch.randn(
+            -(-sample_size // block_size), dimension, block_size,
+            generator=generator
+        ))
+        q = q * torch.diagonal(r, dim1=1, dim2=2).sign().unsqueeze(1)
+        return q.transpose(1, 2).reshape(-1, dimension)[:sample_size]
+
+    rotation_size = rotation.shape[0]
+    row_index = torch.cat([
+        torch.randperm(rotation_size, generator=generator)[
+            :min(rotation_size, sample_size - start)
+        ]
+        for start in range(0, sample_size, rotation_size)
+    ])
+    signs = torch.randint(
+        0, 2, (sample_size, 1), generator=generator
+    ) * 2 - 1
+    return rotation[row_index] * signs
+
+
+class DctSphereSampler(Sampler):
+
+    # low-frequency directions without a stored basis: gaussian DCT
+    # coefficients of every channel in the band start <= max(u, v) < end,
+    # turned into pixels by a truncated separable inverse DCT, i.e. two
+    # matmuls with [end, H] and [end, W] matrices per sample
+
+    def __init__(self, shape, device, start=0, end=None, epsilon=1e-7):
+        super().__init__(device)
+        end = math.ceil(min(shape[-2:]) / 8) if end is None else end
+        assert 0 <= start < end <= min(shape[-2:])
+
+        self._shape = shape
+        self._end = end
+        self._epsilon = epsilon
+
+        self._row_transform = _compute_dct_matrix(shape[-2], end).to(device)
+        self._column_transform = _compute_dct_matrix(
+            shape[-1], end
+        ).to(device)
+
+        frequency = torch.arange(end)
+        self._mask = (
+            torch.maximum(frequency.unsqueeze(1), frequency) >= start
+        ).to(device)
+        self._dimension = shape[:-2].numel() * self._mask.sum().item()
+
+    def sample(self, sample_size, generator=None):
+        coefficients = torch.randn(
+            sample_size, *self._shape[:-2], self._end, self._end,
+            generator=generator
+        ).to(self._device) * self._mask
+
+        # the truncated transform is orthonormal, so is the result
+        coefficients = coefficients / coefficients.flatten(1).norm(
+            dim=1).clamp(self._epsilon).view(-1, *[1] * len(self._shape))
+        return (
+            self._row_transform.t() @ coefficients @ self._column_transform
+        )
+
+
+class DctBallSampler(DctSphereSampler):
+
+    def __init__(self, shape, device, start=0, end=None, epsilon=1e-7):
+        super().__init__(shape, device, start, end, epsilon)
+        self._ratio = torch.rand((1,)).item() ** (1/self._dimension)
+
+    def sample(self, sample_size, generator=None):
+        return self._ratio * super().sample(sample_size, generator)
+
+
+class UpsampledSphereSampler(Sampler):
+
+    # low-frequency directions without a stored basis: gaussian noise of
+    # resolution x resolution pixels per channel, bilinearly upsampled
+    # to the image size
+
+    def __init__(self, shape, device, resolution=None, epsilon=1e-7):
+        super().__init__(device)
+        self._shape = shape
+        self._resolution = (
+            math.ceil(min(shape[-2:]) / 8) if resolution is None
+            else resolution
+        )
+        self._epsilon = epsilon
+        self._dimension = shape[:-2].numel() * self._resolution ** 2
+
+    def sample(self, sample_size, generator=None):
+        noise = F.interpolate(
+            torch.randn(
+                sample_size, *self._shape[:-2],
+                self._resolution, self._resolution,
+                generator=generator
+            ).to(self._device),
+            size=tuple(self._shape[-2:]), mode='bilinear',
+            align_corners=False
+        )
+        return noise / noise.flatten(1).norm(dim=1).clamp(
+            self._epsilon).view(-1, *[1] * len(self._shape))
+
+
+class UpsampledBallSampler(UpsampledSphereSampler):
+
+    def __init__(self, shape, device, resolution=None, epsilon=1e-7):
+        super().__init__(shape, device, resolution, epsilon)
+        self._ratio = torch.rand((1,)).item() ** (1/self._dimension)
+
+    def sample(self, sample_size, generator=None):
+        return self._ratio * super().sample(sample_size, generator)
+
+
+def _reduce_precision(basis, precision, block_size=1024):
+    # converted block_size rows at a time, so a memory-mapped basis is
+    # never loaded as float32 as a whole
+    if precision == 'float32':
+        return basis, None
+    elif precision in ('bfloat16', 'float16'):
+        dtype = getattr(torch, precision)
+        result = torch.empty(basis.shape, dtype=dtype, device=basis.device)
+        for start in range(0, basis.shape[0], block_size):
+            result[start:start + block_size] = (
+                basis[start:start + block_size].to(dtype)
+            )
+        return result, None
+    elif precision == 'int8':
+        result = torch.empty(
+            basis.shape, dtype=torch.int8, device=basis.device
+        )
+        scales = torch.empty(basis.shape[0], device=basis.device)
+        for start in range(0, basis.shape[0], block_size):
+            block = basis[start:start + block_size].float().flatten(1)
+            block_scales = block.abs().amax(dim=1).clamp(min=1e-30) / 127
+            result[start:start + block_size] = (
+                block / block_scales.unsqueeze(1)
+            ).round().clamp(-127, 127).to(torch.int8).view(
+                -1, *basis.shape[1:]
+            )
+            scales[start:start + block_size] = block_scales
+        return result, scales
+    else:
+        raise Exception('unsupported basis precision')
+
+
+def _compute_dct_matrix(size, row_size):
+    # the first row_size rows of the orthonormal DCT-II matrix
+    position = torch.arange(size, dtype=torch.float64)
+    frequency = torch.arange(row_size, dtype=torch.float64).unsqueeze(1)
+    matrix = torch.cos(
+        math.pi * (2 * position + 1) * frequency / (2 * size)
+    ) * math.sqrt(2 / size)
+    matrix[0] /= math.sqrt(2)
+    return matrix.float()
 
 
 class SamplerDecorator(Sampler):
@@ -77,7 +392,7 @@ class SamplerDecorator(Sampler):
         self._sampler = sampler
 
     @abstractmethod
-    def sample(self, sample_size):
+    def sample(self, sample_size, generator=None):
         pass
 
 
@@ -87,16 +402,86 @@ class SamplerWithOutputDevice(SamplerDecorator):
         super().__init__(sampler)
         self._output_device = output_device
 
-    def sample(self, sample_size):
-        return self._sampler.sample(sample_size).to(self._output_device)
+    def sample(self, sample_size, generator=None):
+        return self._sampler.sample(sample_size, generator).to(
+            self._output_device
+        )
+
+
+class PrefetchingSampler(SamplerDecorator):
+
+    # draws the next buffer_size batches in a background thread while the
+    # caller runs the model; a request of another sample_size drains the
+    # buffer. The draws use a generator of their own in submission order,
+    # so the directions only depend on the seed, the buffer size and the
+    # sequence of requested sizes
+
+    def __init__(self, sampler, seed, buffer_size=2):
+        super().__init__(sampler)
+        self._generator = torch.Generator()
+        self._generator.manual_seed(seed)
+        self._buffer_size = buffer_size
+
+        self._executor = None
+        self._executor_pid = None
+        self._pending = deque()
+        self._sample_size = None
+
+    def sample(self, sample_size, generator=None):
+        if generator is not None:
+            return self._sampler.sample(sample_size, generator)
+
+        self._check_fork()
+        if sample_size != self._sample_size:
+            self._drain()
+            self._sample_size = sample_size
+
+        self._fill()
+        future = self._pending.popleft()
+        self._fill()
+        return future.result()
+
+    def manual_seed(self, seed):
+        self._check_fork()
+        self._drain()
+        self._generator.manual_seed(seed)
+
+    def _fill(self):
+        while len(self._pending) < self._buffer_size:
+            self._pending.append(self._executor.submit(
+                self._sampler.sample, self._sample_size, self._generator
+            ))
+
+    def _drain(self):
+        # waited for rather than cancelled, a cancelled draw may or may not
+        # have advanced the generator
+        while self._pending:
+            self._pending.popleft().result()
+
+    def _check_fork(self):
+        # neither the worker thread nor its pending draws survive a fork
+        if self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(1)
+            self._executor_pid = os.getpid()
+            self._pending.clear()
 
 
 class SamplerFactory:
 
+    _BASIS_NAMES = (
+        'subspace_sphere', 'subspace_ball', 'orthogonal_subspace_sphere'
+    )
+
+    def needs_basis(self, name):
+        return name in self._BASIS_NAMES
+
     def create_sampler(
             self, name,
             shape=None, basis=None,
-            device='cpu'
+            device='cpu',
+            band_start=0, band_end=None, resolution=None,
+            block_size=None, num_threads=1, precision='float32',
+            rotation_size=None,
     ):
         if name == 'sphere':
             assert shape is not None
@@ -106,10 +491,40 @@ class SamplerFactory:
             sampler = BallSampler(shape, device)
         elif name == 'subspace_sphere':
             assert basis is not None
-            sampler = SubspaceSphereSampler(basis, device)
+            sampler = SubspaceSphereSampler(
+                basis, device,
+                block_size=block_size, num_threads=num_threads,
+                precision=precision
+            )
         elif name == 'subspace_ball':
             assert basis is not None
-            sampler = SubspaceBallSampler(basis, device)
+            sampler = SubspaceBallSampler(
+                basis, device,
+                block_size=block_size, num_threads=num_threads,
+                precision=precision
+            )
+        elif name == 'orthogonal_sphere':
+            assert shape is not None
+            sampler = OrthogonalSphereSampler(shape, device, rotation_size)
+        elif name == 'orthogonal_subspace_sphere':
+            assert basis is not None
+            sampler = OrthogonalSubspaceSphereSampler(
+                basis, device, rotation_size,
+                block_size=block_size, num_threads=num_threads,
+                precision=precision
+            )
+        elif name == 'dct_sphere':
+            assert shape is not None
+            sampler = DctSphereSampler(shape, device, band_start, band_end)
+        elif name == 'dct_ball':
+            assert shape is not None
+            sampler = DctBallSampler(shape, device, band_start, band_end)
+        elif name == 'upsampled_sphere':
+            assert shape is not None
+            sampler = UpsampledSphereSampler(shape, device, resolution)
+        elif name == 'upsampled_ball':
+            assert shape is not None
+            sampler = UpsampledBallSampler(shape, device, resolution)
         else:
             raise Exception('unsupported batch sampler')
         return sampler
@@ -121,9 +536,32 @@ class SamplerWithOutputDeviceFactory(SamplerFactory):
             self, name,
             shape=None, basis=None,
             device='cpu',
+            band_start=0, band_end=None, resolution=None,
+            block_size=None, num_threads=1, precision='float32',
+            rotation_size=None,
             output_device='cpu',
     ):
         sampler = super().create_sampler(
-            name, shape, basis, device
+            name, shape, basis, device, band_start, band_end, resolution,
+            block_size, num_threads, precision, rotation_size
         )
         return SamplerWithOutputDevice(sampler, output_device)
+
+
+class PrefetchingSamplerFactory(SamplerFactory):
+
+    def create_sampler(
+            self, name,
+            shape=None, basis=None,
+            device='cpu',
+            band_start=0, band_end=None, resolution=None,
+            block_size=None, num_threads=1, precision='float32',
+            rotation_size=None,
+            seed=0,
+            buffer_size=2,
+    ):
+        sampler = super().create_sampler(
+            name, shape, basis, device, band_start, band_end, resolution,
+            block_size, num_threads, precision, rotation_size
+        )
+        return PrefetchingSampler(sampler, seed, buffer_size)
@@ -1,7 +1,16 @@
 from abc import ABC, abstractmethod
+import os
 import torch
 import math
+import hashlib
+import tempfile
+import warnings
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from torch.utils.data import Subset
+from subattack.strategies.pools import decode_pool_block
+from subattack.strategies.pools import PoolFetcherFactory
 
 
 class SvdBasisFetcher(ABC):
@@ -17,6 +26,12 @@ class SvdBasisFetcher(ABC):
         pool_device = self._pool.device
 
         basis = self._compute_svd(self._pool.view(self._pool.shape[0], -1))
+        if basis.shape[0] < self._end:
+            raise Exception(
+                'the pool spans only {} directions, fewer than {}'.format(
+                    basis.shape[0], self._end
+                )
+            )
 
         return basis[self._start:self._end].view(
             self._end-self._start, *self._pool.shape[1:]
@@ -35,7 +50,7 @@ class TorchSvdBasisFetcher(SvdBasisFetcher):
 
     # memory eagar but very fast
     def _compute_svd(self, vectors):
-        _, _, result = torch.svd(vectors.to(self._device))
+        _, _, result = torch.svd(decode_pool_block(vectors.to(self._device)))
         return result.t()
 
 
@@ -44,27 +59,334 @@ class NumpySvdBasisFetcher(SvdBasisFetcher):
     # memory economical but slow
     def _compute_svd(self, vectors):
         _, _, result = np.linalg.svd(
-            vectors.cpu().numpy(), full_matrices=False
+            decode_pool_block(vectors.cpu()).numpy(), full_matrices=False
         )
         return torch.from_numpy(result)
 
 
+class GramSvdBasisFetcher(SvdBasisFetcher):
+
+    def __init__(self, pool, start, end, block_size=4096, epsilon=1e-12):
+        super().__init__(pool, start, end)
+        self._block_size = block_size
+        self._epsilon = epsilon
+
+    # eigendecomposes the pool_size x pool_size gram matrix and maps its
+    # eigenvectors back to right singular vectors; accumulated in float64
+    # block by block, so that the bottom directions stay accurate; only the
+    # directions within the numerical rank of the pool are returned
+    def _compute_svd(self, vectors):
+        vectors = vectors.cpu()
+
+        gram = torch.zeros(
+            vectors.shape[0], vectors.shape[0], dtype=torch.float64
+        )
+        for block in vectors.split(self._block_size, dim=1):
+            block = decode_pool_block(block, torch.float64)
+            gram += block @ block.t()
+
+        coefficients = compute_gram_coefficients(gram, self._epsilon)
+
+        result = torch.empty(
+            coefficients.shape[0], vectors.shape[1], dtype=torch.float32
+        )
+        for start in range(0, vectors.shape[1], self._block_size):
+            end = start + self._block_size
+            result[:, start:end] = coefficients @ decode_pool_block(
+                vectors[:, start:end], torch.float64
+            )
+        return result
+
+
+class RandomizedSvdBasisFetcher(SvdBasisFetcher):
+
+    def __init__(self, pool, start, end, oversampling=10, power_iterations=2):
+        assert start == 0
+        super().__init__(pool, start, end)
+        self._oversampling = oversampling
+        self._power_iterations = power_iterations
+
+    # randomized range finder: only the top end+oversampling right singular
+    # vectors are approximated, which is cheap for small top subspaces
+    def _compute_svd(self, vectors):
+        vectors = decode_pool_block(vectors.cpu())
+
+        size = min(self._end + self._oversampling, vectors.shape[0])
+        range_basis, _ = torch.linalg.qr(
+            vectors.t() @ torch.randn(vectors.shape[0], size)
+        )
+        for _ in range(self._power_iterations):
+            range_basis, _ = torch.linalg.qr(
+                vectors.t() @ (vectors @ range_basis)
+            )
+
+        _, _, result = torch.linalg.svd(
+            vectors @ range_basis, full_matrices=False
+        )
+        return (range_basis @ result.t()).t()
+
+
+class SvdBasisFetcherWithCache(SvdBasisFetcher):
+
+    # the full set of right singular vectors is stored as a .npy file keyed
+    # by the content of the pool and the svd backend; it is loaded memory
+    # mapped, so every subspace of it is a zero-copy slice
+
+    def __init__(self, pool, start, end, svd_basis_fetcher, name, cache_dir):
+        super().__init__(pool, start, end)
+        self._svd_basis_fetcher = svd_basis_fetcher
+        self._name = name
+        self._cache_dir = cache_dir
+
+    def _compute_svd(self, vectors):
+        path = os.path.join(
+            self._cache_dir, '{}.npy'.format(self._compute_key(vectors))
+        )
+
+        if not os.path.exists(path):
+            os.makedirs(self._cache_dir, exist_ok=True)
+            result = self._svd_basis_fetcher._compute_svd(vectors)
+            temp_path = '{}.{}.npy'.format(path[:-len('.npy')], os.getpid())
+            np.save(temp_path, np.ascontiguousarray(result.cpu().numpy()))
+            os.replace(temp_path, path)
+
+        with warnings.catch_warnings():
+            # the basis is only read, so a read-only mapping is fine
+            warnings.simplefilter('ignore', UserWarning)
+            return torch.from_numpy(np.load(path, mmap_mode='r'))
+
+    def _compute_key(self, vectors):
+        vectors = vectors.detach().cpu().contiguous()
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(
+            str((self._name, tuple(vectors.shape), vectors.dtype)).encode()
+        )
+        digest.update(vectors.numpy().data)
+        return '{}_{}'.format(self._name, digest.hexdigest())
+
+
+class StreamingSvdBasisFetcher:
+
+    # builds the basis straight from a loader: the pool is fetched into a
+    # memory-mapped file as configured by pool and storage, its gram
+    # matrix is accumulated block by block (optionally in several threads)
+    # and the basis is written to another memory-mapped file, so peak
+    # memory grows with pool_size ** 2 instead of pool_size * D. The basis
+    # file is keyed by the configuration and the dataset of the loader, so
+    # later runs on the same split map it without fetching the pool again
+
+    def __init__(
+            self, loader, pool_size, subspace_size, position,
+            pool='random', storage='float32', deduplicate=False,
+            storage_dir=None, num_threads=1, block_size=4096,
+            epsilon=1e-12,
+    ):
+        self._loader = loader
+        self._pool_size = pool_size
+        self._start, self._end = compute_subspace_range(
+            pool_size, subspace_size, position
+        )
+        self._pool = pool
+        self._storage = storage
+        self._deduplicate = deduplicate
+        self._storage_dir = (
+            tempfile.gettempdir() if storage_dir is None else storage_dir
+        )
+        self._num_threads = num_threads
+        self._block_size = block_size
+        self._epsilon = epsilon
+
+    def fetch(self):
+        os.makedirs(self._storage_dir, exist_ok=True)
+
+        basis_path = os.path.join(
+            self._storage_dir, '{}.npy'.format(self._compute_key())
+        )
+        if not os.path.exists(basis_path):
+            pool_path = self._get_temp_path('pool')
+            try:
+                # the global RNG is left as a cache hit leaves it, so
+                # what is drawn after the basis does not depend on it
+                with torch.random.fork_rng(devices=[]):
+                    pool = PoolFetcherFactory().create_pool_fetcher(
+                        name=self._pool, loader=self._loader,
+                        max_size=self._pool_size, device='cpu',
+                        storage=self._storage, path=pool_path,
+                        deduplicate=self._deduplicate,
+                    ).fetch()
+                self._write_basis(pool, basis_path)
+            finally:
+                pool = None
+                if os.path.exists(pool_path):
+                    os.remove(pool_path)
+
+        with warnings.catch_warnings():
+            # the basis is only read, so a read-only mapping is fine
+            warnings.simplefilter('ignore', UserWarning)
+            return torch.from_numpy(np.load(basis_path, mmap_mode='r'))
+
+    def _compute_key(self):
+        # the pool is not read: it is determined by the configuration, the
+        # images of the dataset in loader order and, for the pools which
+        # sample, the state of the global RNG they draw from
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(str((
+            self._pool, self._storage, self._deduplicate, self._pool_size,
+            self._start, self._end, self._epsilon,
+            type(self._loader.sampler).__name__,
+            _describe_dataset(self._loader.dataset),
+        )).encode())
+        if self._pool != 'random':
+            digest.update(torch.get_rng_state().numpy().data)
+        return 'streaming_{}'.format(digest.hexdigest())
+
+    def _write_basis(self, pool, path):
+        shape = pool.shape[1:]
+        pool = pool.view(pool.shape[0], -1)
+        coefficients = self._compute_coefficients(self._compute_gram(pool))
+
+        temp_path = self._get_temp_path('basis')
+        basis = np.lib.format.open_memmap(
+            temp_path, mode='w+', dtype=np.float32,
+            shape=(coefficients.shape[0], *shape)
+        )
+        rows = basis.reshape(coefficients.shape[0], -1)
+        for start, end in self._get_column_blocks(pool.shape[1]):
+            rows[:, start:end] = (
+                coefficients @ self._read_block(pool, start, end)
+            ).numpy()
+        basis.flush()
+        del basis, rows
+        os.replace(temp_path, path)
+
+    def _compute_gram(self, pool):
+        # a single gram matrix: for every column block, each thread adds
+        # the products of its own rows in place, so no partial copies exist
+        size = pool.shape[0]
+        row_size = math.ceil(size / self._num_threads)
+        row_blocks = [
+            (start, min(start + row_size, size))
+            for start in range(0, size, row_size)
+        ]
+        gram = torch.zeros(size, size, dtype=torch.float64)
+
+        with ThreadPoolExecutor(self._num_threads) as executor:
+            for start, end in self._get_column_blocks(pool.shape[1]):
+                block = self._read_block(pool, start, end)
+                list(executor.map(
+                    lambda rows: gram[rows[0]:rows[1]].addmm_(
+                        block[rows[0]:rows[1]], block.t()
+                    ),
+                    row_blocks
+                ))
+        return gram
+
+    def _compute_coefficients(self, gram):
+        coefficients = compute_gram_coefficients(gram, self._epsilon)
+        if coefficients.shape[0] < self._end:
+            raise Exception(
+                'the pool spans only {} directions, fewer than {}'.format(
+                    coefficients.shape[0], self._end
+                )
+            )
+        return coefficients[self._start:self._end]
+
+    def _get_column_blocks(self, size):
+        return [
+            (start, min(start + self._block_size, size))
+            for start in range(0, size, self._block_size)
+        ]
+
+    def _get_temp_path(self, kind):
+        return os.path.join(
+            self._storage_dir,
+            'streaming_{}_{}.tmp.npy'.format(kind, os.getpid())
+        )
+
+    @staticmethod
+    def _read_block(pool, start, end):
+        return decode_pool_block(pool[:, start:end], torch.float64)
+
+
+def _describe_dataset(dataset):
+    # e.g. a split of an ImageFolder: its files, transform and indices
+    if isinstance(dataset, Subset):
+        return (
+            _describe_dataset(dataset.dataset), tuple(dataset.indices)
+        )
+    return (
+        type(dataset).__name__, getattr(dataset, 'samples', None),
+        repr(getattr(dataset, 'transform', None)), len(dataset)
+    )
+
+
+def compute_gram_coefficients(gram, epsilon=1e-12):
+    # rows map the pool to its right singular vectors, singular values in
+    # descending order as with the other backends; directions whose squared
+    # singular value is within the rounding error of the gram matrix are
+    # not determined by the pool, and are left out rather than returned as
+    # vectors which are neither unit nor orthogonal
+    eigenvalues, eigenvectors = torch.linalg.eigh(gram)
+    eigenvalues, eigenvectors = eigenvalues.flip(0), eigenvectors.flip(1)
+    tolerance = max(
+        eigenvalues[0].item() * gram.shape[0] * torch.finfo(gram.dtype).eps,
+        epsilon ** 2
+    )
+    rank = (eigenvalues > tolerance).sum().item()
+    return (eigenvectors[:, :rank] / eigenvalues[:rank].sqrt()).t()
+
+
+def compute_subspace_range(pool_size, subspace_size, position):
+    if position == 'top':
+        start = 0
+        end = subspace_size
+    elif position == 'bottom':
+        start = pool_size - subspace_size
+        end = pool_size
+    elif position == 'middle':
+        start = math.floor((pool_size - subspace_size)/2)
+        end = start + subspace_size
+    else:
+        raise Exception('unsupported position')
+    return start, end
+
+
 class SvdBasisFetcherFactory:
 
-    def create_svd_basis_fetcher(self, name, pool, subspace_size, position):
-        if position == 'top':
-            start = 0
-            end = subspace_size
-        elif position == 'bottom':
-            start = pool.shape[0] - subspace_size
-            end = pool.shape[0]
-        elif position == 'middle':
-            start = math.floor((pool.shape[0] - subspace_size)/2)
-            end = start + subspace_size
+    def create_svd_basis_fetcher(
+            self, name, pool, subspace_size, position, cache_dir=None,
+            oversampling=10
+    ):
+        start, end = compute_subspace_range(
+            pool.shape[0], subspace_size, position
+        )
+
+        if name == 'auto':
+            # the range finder pays off for small top subspaces only;
+            # bottom and middle subspaces need the whole spectrum
+            if (position == 'top' and
+                    2 * (subspace_size + oversampling) <= pool.shape[0]):
+                name = 'randomized'
+            else:
+                name = 'gram'
 
         if name == 'torch':
-            return TorchSvdBasisFetcher(pool, start, end)
+            svd_basis_fetcher = TorchSvdBasisFetcher(pool, start, end)
         elif name == 'numpy':
-            return NumpySvdBasisFetcher(pool, start, end)
+            svd_basis_fetcher = NumpySvdBasisFetcher(pool, start, end)
+        elif name == 'gram':
+            svd_basis_fetcher = GramSvdBasisFetcher(pool, start, end)
+        elif name == 'randomized':
+            svd_basis_fetcher = RandomizedSvdBasisFetcher(
+                pool, start, end, oversampling
+            )
+            # the approximated vectors depend on their number
+            name = 'randomized{}'.format(end + oversampling)
         else:
             raise Exception('unsupported svd')
+
+        if cache_dir is None:
+            return svd_basis_fetcher
+        return SvdBasisFetcherWithCache(
+            pool, start, end, svd_basis_fetcher, name, cache_dir
+        )
@@ -1,3 +1,9 @@
-from .predictors import Predictor, ModulePredictor
+from .predictors import Predictor, ModulePredictor, CachedPredictor
+from .oracles import Oracle, OracleResult
+from .brokers import QueryBroker, BrokerClient
 
-__all__ = ['Predictor', 'ModulePredictor']
+__all__ = [
+    'Predictor', 'ModulePredictor', 'CachedPredictor',
+    'Oracle', 'OracleResult',
+    'QueryBroker', 'BrokerClient',
+]
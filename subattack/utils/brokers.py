@@ -0,0 +1,126 @@
+import time
+import queue
+import asyncio
+import threading
+from concurrent.futures import Future
+
+import torch
+
+
+_STOP = object()
+
+
+class QueryBroker:
+    """Serves the queries of concurrent callers with batched forward passes
+
+    Requests are grouped until they hold max_batch_size images or the first
+    of them has waited max_wait seconds, then the model runs once on their
+    concatenation and every caller receives its own slice of the output.
+    """
+
+    def __init__(self, model, max_batch_size=256, max_wait=0.005):
+        self._model = model
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait
+
+        self._request_queue = queue.Queue()
+        self._batch_count = 0
+        self._image_count = 0
+
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def client(self):
+        return BrokerClient(self)
+
+    def submit(self, image_array):
+        future = Future()
+        self._request_queue.put((image_array, future))
+        return future
+
+    def close(self):
+        self._request_queue.put(_STOP)
+        self._thread.join()
+
+    @property
+    def batch_count(self):
+        return self._batch_count
+
+    @property
+    def mean_batch_size(self):
+        return (
+            self._image_count / self._batch_count
+            if self._batch_count else 0.
+        )
+
+    def _serve(self):
+        leftover = None
+        while True:
+            request = (
+                self._request_queue.get() if leftover is None else leftover
+            )
+            leftover = None
+            if request is _STOP:
+                return
+
+            request_list = [request]
+            size = request[0].shape[0]
+            deadline = time.monotonic() + self._max_wait
+            while size < self._max_batch_size:
+                try:
+                    request = self._request_queue.get(
+                        timeout=max(0., deadline - time.monotonic())
+                    )
+                except queue.Empty:
+                    break
+                if (request is _STOP or
+                        size + request[0].shape[0] > self._max_batch_size):
+                    # it opens the next batch, or stops after this one
+                    leftover = request
+                    break
+                request_list.append(request)
+                size += request[0].shape[0]
+
+            self._run(request_list)
+
+    def _run(self, request_list):
+        try:
+            output = self._model(
+                torch.cat([image_array for image_array, _ in request_list])
+            )
+        except Exception as error:
+            for _, future in request_list:
+                future.set_exception(error)
+            return
+
+        self._batch_count += 1
+        self._image_count += output.shape[0]
+
+        start = 0
+        for image_array, future in request_list:
+            future.set_result(output[start:start + image_array.shape[0]])
+            start += image_array.shape[0]
+
+
+class BrokerClient:
+    """A drop-in for a model which sends its queries through a QueryBroker
+
+    Every attack should own a client: query_count is then exactly the
+    number of images its attack had evaluated by the model.
+    """
+
+    def __init__(self, broker: QueryBroker):
+        self._broker = broker
+        self._query_count = 0
+
+    def __call__(self, image_array):
+        self._query_count += image_array.shape[0]
+        return self._broker.submit(image_array).result()
+
+    async def query_async(self, image_array):
+        self._query_count += image_array.shape[0]
+        return await asyncio.wrap_future(self._broker.submit(image_array))
+
+    @property
+    def query_count(self):
+        return self._query_count
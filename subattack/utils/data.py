@@ -1,6 +1,7 @@
 import json
 
 import os
+import torch
 import torchvision.datasets as datasets
 import torchvision.transforms as transforms
 from torch.utils.data import random_split
@@ -22,7 +23,8 @@ def generate_1by1(loader, device='cpu'):
             yield image, label
 
 
-def get_loaders(data_dir, size_manifold, size_attack, num_workers, batch_size):
+def get_loaders(data_dir, size_manifold, size_attack, num_workers, batch_size,
+                seed):
 
     val_dir = os.path.join(data_dir, 'val')
     val_dataset = datasets.ImageFolder(val_dir, transforms.Compose([
@@ -31,8 +33,12 @@ def get_loaders(data_dir, size_manifold, size_attack, num_workers, batch_size):
         transforms.ToTensor(),
     ]))
 
+    # the split has its own generator, so that it does not depend on how
+    # much of the global RNG building the model has used, e.g. none for a
+    # remote model
     manifold_dataset, attack_dataset = random_split(
-        val_dataset, [size_manifold, size_attack])
+        val_dataset, [size_manifold, size_attack],
+        generator=torch.Generator().manual_seed(seed))
 
     manifold_loader = DataLoader(
         manifold_dataset, batch_size=batch_size, shuffle=False,
@@ -53,3 +59,21 @@ def get_subspace_loader(data_dir, num_workers, batch_size):
     return DataLoader(
         subspace_dataset, batch_size=batch_size, shuffle=False,
         num_workers=num_workers, pin_memory=True)
+
+
+def select_attack_indices(loader, predict_batch, num_attack, device='cpu'):
+    # dataset indices of the first num_attack correctly classified images,
+    # in the order in which generate_1by1 would visit them
+    index_list = []
+    offset = 0
+    for image_array, label_array in loader:
+        image_array, label_array = (
+            image_array.to(device), label_array.to(device)
+        )
+        correct = predict_batch(image_array) == label_array
+        for i in correct.nonzero().flatten().tolist():
+            index_list.append(offset + i)
+            if len(index_list) >= num_attack:
+                return index_list
+        offset += image_array.shape[0]
+    return index_list
@@ -0,0 +1,47 @@
+import torch
+from collections import namedtuple
+
+from subattack.strategies.loss import LossEvaluator
+
+
+OracleResult = namedtuple('OracleResult', ['label', 'loss'])
+
+
+class Oracle:
+    """A drop-in for a model which evaluates logits once per distinct input"""
+
+    def __init__(self, model, loss_evaluator: LossEvaluator, cache_size=2):
+        self._model = model
+        self._loss_evaluator = loss_evaluator
+        self._cache_size = cache_size
+        self._cache = []
+
+    def __call__(self, image_array):
+        for cached_image_array, logits in self._cache:
+            if (cached_image_array.shape == image_array.shape and
+                    torch.equal(cached_image_array, image_array)):
+                return logits
+
+        logits = self._model(image_array)
+
+        # only individual images are cached: they are the ones queried
+        # repeatedly, and batches of probes would pin a lot of memory
+        if image_array.shape[0] == 1 and self._cache_size > 0:
+            self._cache.append((image_array.clone(), logits))
+            self._cache = self._cache[-self._cache_size:]
+
+        return logits
+
+    def query(self, image, label):
+        result = self.query_batch(image.unsqueeze(0), label.unsqueeze(0))
+        return OracleResult(*(value.squeeze(0) for value in result))
+
+    def query_batch(self, image_array, label_array):
+        logits = self(image_array)
+        return OracleResult(
+            logits.argmax(dim=1),
+            self._loss_evaluator.compute_from_logits(logits, label_array)
+        )
+
+    def clear(self):
+        self._cache = []
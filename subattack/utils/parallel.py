@@ -0,0 +1,76 @@
+import queue
+import multiprocessing
+
+import torch
+
+
+def run_sharded(
+        attack, index_list, num_workers, num_threads=None, finalize=None,
+        collect=None
+):
+    """Calls attack(order, index_list[order]) for every order in worker
+    processes and yields the results in order as soon as they are ready
+
+    Worker w handles the orders w, w + num_workers, ... so the assignment
+    of images to workers is deterministic. Workers are forked, so attack
+    may be a closure over the model and the attacker of the caller.
+    finalize is called in every worker after its last attack, and what it
+    returns is passed to collect in the process of the caller.
+    """
+
+    # a forked child cannot use the CUDA context of its parent
+    if torch.cuda.is_initialized():
+        raise Exception('cannot fork workers once CUDA is initialized')
+
+    if num_threads is None:
+        num_threads = max(1, torch.get_num_threads() // num_workers)
+
+    context = multiprocessing.get_context('fork')
+    result_queue = context.Queue()
+    processes = [
+        context.Process(
+            target=_work,
+            args=(attack, index_list, worker, num_workers,
+                  num_threads, finalize, result_queue)
+        )
+        for worker in range(num_workers)
+    ]
+    for process in processes:
+        process.start()
+
+    result_dict = {}
+    next_order = 0
+    final_count = 0
+    try:
+        while next_order < len(index_list) or final_count < num_workers:
+            try:
+                order, result = result_queue.get(timeout=1)
+                if order is not None:
+                    result_dict[order] = result
+                else:
+                    final_count += 1
+                    if collect is not None:
+                        collect(result)
+            except queue.Empty:
+                if any(process.exitcode not in (None, 0)
+                       for process in processes):
+                    raise Exception('worker process failed')
+
+            while next_order in result_dict:
+                yield result_dict.pop(next_order)
+                next_order += 1
+    finally:
+        for process in processes:
+            if process.is_alive() and final_count < num_workers:
+                process.terminate()
+            process.join()
+
+
+def _work(
+        attack, index_list, worker, num_workers, num_threads, finalize,
+        result_queue
+):
+    torch.set_num_threads(num_threads)
+    for order in range(worker, len(index_list), num_workers):
+        result_queue.put((order, attack(order, index_list[order])))
+    result_queue.put((None, None if finalize is None else finalize()))
@@ -1,4 +1,7 @@
+import hashlib
+import torch
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 
 
 class Predictor(ABC):
@@ -18,3 +21,90 @@ class ModulePredictor(Predictor):
 
     def predict_batch(self, image_array):
         return self._module(image_array).argmax(dim=1)
+
+
+class PredictorDecorator(Predictor):
+
+    def __init__(self, predictor):
+        self._predictor = predictor
+
+    @abstractmethod
+    def predict_batch(self, image_array):
+        pass
+
+
+class CachedPredictor(PredictorDecorator):
+    """Keeps the predictions of the max_size most recently queried images
+
+    Images are keyed by a hash of their content, so it pays off when
+    identical inputs are queried again, e.g. under the discrete convention.
+    """
+
+    def __init__(self, predictor, max_size):
+        super().__init__(predictor)
+        self._max_size = max_size
+        self._cache = OrderedDict()
+        self._hit_count = 0
+        self._miss_count = 0
+        self._hit_mask = None
+
+    def predict_batch(self, image_array):
+        keys = [self._hash(image) for image in image_array]
+
+        found = {}
+        missing = OrderedDict()
+        hit_list = []
+        for i, key in enumerate(keys):
+            if key in found or key in missing:
+                hit_list.append(True)
+            elif key in self._cache:
+                self._cache.move_to_end(key)
+                found[key] = self._cache[key]
+                hit_list.append(True)
+            else:
+                missing[key] = i
+                hit_list.append(False)
+        self._hit_count += sum(hit_list)
+        self._miss_count += len(hit_list) - sum(hit_list)
+        self._hit_mask = torch.tensor(hit_list, device=image_array.device)
+
+        if missing:
+            result_array = self._predictor.predict_batch(
+                image_array[list(missing.values())]
+            )
+            for key, result in zip(missing, result_array):
+                found[key] = result.clone()
+                self._store(key, found[key])
+
+        return torch.stack([found[key] for key in keys])
+
+    @property
+    def hit_count(self):
+        return self._hit_count
+
+    @property
+    def hit_mask(self):
+        # which rows of the last batch were answered from the cache
+        return self._hit_mask
+
+    @property
+    def miss_count(self):
+        return self._miss_count
+
+    @property
+    def hit_rate(self):
+        total_count = self._hit_count + self._miss_count
+        return self._hit_count / total_count if total_count else 0.
+
+    def _store(self, key, result):
+        self._cache[key] = result
+        while len(self._cache) > self._max_size:
+            self._cache.popitem(last=False)
+
+    @staticmethod
+    def _hash(image):
+        image = image.detach().cpu().contiguous()
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(str((tuple(image.shape), image.dtype)).encode())
+        digest.update(image.numpy().tobytes())
+        return digest.digest()
@@ -0,0 +1,214 @@
+import os
+import time
+import queue
+import random
+import threading
+import http.client
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from subattack.utils.predictors import Predictor
+
+
+# images travel as raw buffers of shape X-Shape; uint8 sends 8-bit pixels,
+# which is lossless only for images on the 1/255 grid of the discrete
+# convention, the float encodings send the images as they are
+
+def encode_images(image_array, encoding):
+    image_array = image_array.detach().cpu()
+    if encoding == 'uint8':
+        image_array = (image_array * 255).round().clamp(0, 255).to(
+            torch.uint8
+        )
+    elif encoding == 'float16':
+        image_array = image_array.half()
+    elif encoding == 'float32':
+        image_array = image_array.float()
+    else:
+        raise Exception('unsupported encoding')
+    return image_array.contiguous().numpy().tobytes()
+
+
+def decode_images(body, shape, encoding):
+    if encoding not in ('uint8', 'float16', 'float32'):
+        raise Exception('unsupported encoding')
+    image_array = torch.from_numpy(
+        np.frombuffer(body, dtype=encoding).reshape(
+            _parse_shape(shape)
+        ).copy()
+    ).float()
+    if encoding == 'uint8':
+        image_array /= 255
+    return image_array
+
+
+def encode_output(output):
+    output = output.detach().cpu().contiguous().numpy()
+    return output.tobytes(), {
+        'X-Shape': ','.join(str(size) for size in output.shape),
+        'X-Dtype': output.dtype.name,
+    }
+
+
+def decode_output(body, shape, dtype):
+    return torch.from_numpy(
+        np.frombuffer(body, dtype=dtype).reshape(_parse_shape(shape)).copy()
+    )
+
+
+def _parse_shape(shape):
+    return tuple(int(size) for size in shape.split(','))
+
+
+class RemoteModel:
+    """A drop-in for a model served over HTTP, e.g. by serve_model.py
+
+    Connections are kept alive and reused. At most max_concurrency
+    requests are in flight at once, and batches larger than max_batch_size
+    are split into requests sent side by side. Connection errors,
+    timeouts and 429 or 5xx answers are retried up to max_retries times
+    with exponential backoff. rate, if given, limits the requests sent
+    per second.
+    """
+
+    def __init__(
+            self, url, encoding='float32', max_concurrency=4,
+            max_batch_size=None, max_retries=3, backoff=0.1, rate=None,
+            timeout=30.
+    ):
+        url = urlsplit(url)
+        self._host = url.hostname
+        self._port = url.port
+        self._prefix = url.path.rstrip('/')
+
+        self._encoding = encoding
+        self._max_concurrency = max_concurrency
+        self._max_batch_size = max_batch_size
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._rate = rate
+        self._timeout = timeout
+
+        self._request_count = 0
+        self._retry_count = 0
+        self._pid = None
+        self._check_fork()
+
+    def __call__(self, image_array):
+        return self.query(image_array, 'logits')
+
+    def query(self, image_array, output='logits'):
+        """Returns the logits or the labels of a batch of images"""
+        self._check_fork()
+
+        if (self._max_batch_size is None or
+                image_array.shape[0] <= self._max_batch_size):
+            result = self._request(output, image_array)
+        else:
+            result = torch.cat(list(self._executor.map(
+                lambda chunk: self._request(output, chunk),
+                image_array.split(self._max_batch_size)
+            )))
+        return result.to(image_array.device)
+
+    @property
+    def request_count(self):
+        return self._request_count
+
+    @property
+    def retry_count(self):
+        return self._retry_count
+
+    def _request(self, output, image_array):
+        body = encode_images(image_array, self._encoding)
+        headers = {
+            'Content-Type': 'application/octet-stream',
+            'X-Shape': ','.join(str(size) for size in image_array.shape),
+            'X-Encoding': self._encoding,
+        }
+
+        for attempt in range(self._max_retries + 1):
+            if attempt > 0:
+                with self._count_lock:
+                    self._retry_count += 1
+                time.sleep(
+                    self._backoff * 2 ** (attempt - 1) * random.uniform(1, 2)
+                )
+            self._wait_for_rate()
+
+            # the pool holds one slot per allowed request in flight; an
+            # empty slot is a connection not opened yet or dropped
+            connection = self._pool.get()
+            try:
+                if connection is None:
+                    connection = http.client.HTTPConnection(
+                        self._host, self._port, timeout=self._timeout
+                    )
+                connection.request(
+                    'POST', '{}/{}'.format(self._prefix, output),
+                    body, headers
+                )
+                response = connection.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException) as error:
+                connection.close()
+                connection = None
+                last_error = error
+                continue
+            finally:
+                self._pool.put(connection)
+
+            with self._count_lock:
+                self._request_count += 1
+            if response.status == 200:
+                return decode_output(
+                    data, response.getheader('X-Shape'),
+                    response.getheader('X-Dtype')
+                )
+
+            last_error = Exception('remote model answered {}: {}'.format(
+                response.status, data[:200].decode(errors='replace')
+            ))
+            if response.status != 429 and response.status < 500:
+                raise last_error
+
+        raise Exception(
+            'remote model failed after {} retries'.format(self._max_retries)
+        ) from last_error
+
+    def _wait_for_rate(self):
+        # requests are scheduled 1 / rate seconds apart
+        if not self._rate:
+            return
+        with self._rate_lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + 1 / self._rate
+        time.sleep(slot - now)
+
+    def _check_fork(self):
+        # sockets, threads and locks must not be shared with a parent
+        if self._pid != os.getpid():
+            self._pool = queue.LifoQueue()
+            for _ in range(self._max_concurrency):
+                self._pool.put(None)
+            self._executor = ThreadPoolExecutor(self._max_concurrency)
+            self._rate_lock = threading.Lock()
+            self._next_slot = 0.
+            # requests of split batches and of attack threads run
+            # concurrently, and += on the counters is not atomic
+            self._count_lock = threading.Lock()
+            self._pid = os.getpid()
+
+
+class RemotePredictor(Predictor):
+    """Predicts through a RemoteModel, which only sends back the labels"""
+
+    def __init__(self, remote_model: RemoteModel):
+        self._remote_model = remote_model
+
+    def predict_batch(self, image_array):
+        return self._remote_model.query(image_array, 'labels')
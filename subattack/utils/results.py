@@ -1,6 +1,11 @@
 import os
-import pandas as pd
+import io
+import csv
+import math
+import heapq
+import threading
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from torchvision.transforms.functional import to_pil_image
 
 from subattack.strategies.adv_checkers import AdvChecker
@@ -9,7 +14,7 @@ from subattack.strategies.adv_checkers import AdvChecker
 class AttackResult:
 
     def __init__(self, image, label, adv_image, adv_label, cost,
-                 adv_checker: AdvChecker):
+                 adv_checker: AdvChecker, cache_hits=None):
         self._image = image
         self._label = label
         self._adv_image = adv_image
@@ -17,6 +22,10 @@ class AttackResult:
         self._cost = cost
         self._adv_checker = adv_checker
 
+        # cost counts every query issued by the attacker, including the
+        # cache_hits of them which were answered without running the model
+        self._cache_hits = cache_hits
+
     def successful(self):
         return self._adv_checker.successful(self._label, self._adv_label)
 
@@ -28,30 +37,42 @@ class AttackResult:
     def linf_perturbation(self):
         return (self._image - self._adv_image).abs().max().item()
 
-    def save_image(self, order, idx_to_label, result_dir):
-        to_pil_image(self._image.cpu()).save(
+    def save_image(self, order, idx_to_label, result_dir,
+                   image_writer=None, overwrite=True):
+        self._save(
+            self._image,
             os.path.join(
                 result_dir,
                 '{:04d}_original_{}_{}.png'.format(
                     order, self._label.item(),
                     idx_to_label[self._label.item()]
                 )
-            )
+            ),
+            image_writer, overwrite
         )
 
-    def save_adv_image(self, order, idx_to_label, result_dir):
-        to_pil_image(self._adv_image.cpu()).save(
+    def save_adv_image(self, order, idx_to_label, result_dir,
+                       image_writer=None, overwrite=True):
+        self._save(
+            self._adv_image,
             os.path.join(
                 result_dir,
                 '{:04d}_adversarial_{}_{}.png'.format(
                     order, self._adv_label.item(),
                     idx_to_label[self._adv_label.item()])
-            )
+            ),
+            image_writer, overwrite
         )
 
+    @staticmethod
+    def _save(image, path, image_writer, overwrite):
+        if image_writer is None:
+            image_writer = ImageWriter(num_threads=0)
+        image_writer.write(image, path, overwrite)
+
     @property
     def detail(self):
-        return OrderedDict([
+        detail = OrderedDict([
             ('label', self._label.item()),
             ('adv_label', self._adv_label.item()),
             ('successful', self.successful()),
@@ -59,61 +80,229 @@ class AttackResult:
             ('linf', self.linf_perturbation),
             ('l2', self.l2_perturbation)
         ])
+        if self._cache_hits is not None:
+            detail['cache_hits'] = self._cache_hits
+        return detail
 
     def print_detail(self):
         print('-' * 30)
         print('**detail**')
-        print(pd.Series(self.detail))
+        _print_dict(self.detail)
         print('-' * 30)
 
 
+class ImageWriter:
+
+    # encodes and writes PNGs in background threads; at most max_pending
+    # images wait in the queue, beyond that write blocks the caller
+
+    def __init__(self, num_threads=2, max_pending=16):
+        self._executor = (
+            ThreadPoolExecutor(num_threads) if num_threads > 0 else None
+        )
+        self._semaphore = threading.BoundedSemaphore(max_pending)
+        self._error = None
+
+    def write(self, image, path, overwrite=True):
+        self._raise_error()
+
+        if not overwrite and os.path.exists(path):
+            return
+
+        image = image.detach().cpu().clone()
+        if self._executor is None:
+            self._write(image, path)
+            return
+
+        self._semaphore.acquire()
+        future = self._executor.submit(self._write, image, path)
+        future.add_done_callback(self._on_done)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        self._raise_error()
+
+    def _on_done(self, future):
+        self._semaphore.release()
+        if future.exception() is not None:
+            self._error = future.exception()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    @staticmethod
+    def _write(image, path):
+        to_pil_image(image).save(path)
+
+
 class AttackDetailCollection:
 
+    # details are appended to detail.csv as they arrive and the summary
+    # statistics are kept as running aggregates, so neither grows with the
+    # number of images already attacked; summary.csv is rewritten with
+    # every save, so a preempted run keeps an up to date summary. The
+    # columns are fixed by the first detail (or by the header of a resumed
+    # detail.csv), and a detail with any other key is rejected
+
     def __init__(self):
-        self._detail_list = []
+        self._size = 0
+        self._saved_size = 0
+        self._header = None
+        self._header_saved = False
+        self._pending_list = []
+
+        self._success_count = 0
+        self._cost = _RunningStatistic()
+        self._linf = _RunningStatistic()
+        self._l2 = _RunningStatistic()
+
+    def __len__(self):
+        return self._size
 
     def append(self, detail):
-        self._detail_list.append(detail)
+        # the columns of detail.csv are those of the first detail, so a
+        # later one may leave some empty but must not bring new ones
+        if self._header is None:
+            self._header = list(detail)
+        unknown_list = [key for key in detail if key not in self._header]
+        if unknown_list:
+            raise Exception('detail.csv has no column for {}'.format(
+                ', '.join(unknown_list)
+            ))
+
+        self._size += 1
+        self._pending_list.append(detail)
+
+        if detail['successful']:
+            self._success_count += 1
+            self._cost.add(detail['cost'])
+            self._linf.add(detail['linf'])
+            self._l2.add(detail['l2'])
 
     def save_detail(self, result_dir):
-        df = pd.DataFrame(self._detail_list)
-        df.to_csv(os.path.join(result_dir, 'detail.csv'))
+        with open(os.path.join(result_dir, 'detail.csv'), 'a',
+                  newline='') as file:
+            writer = csv.writer(file)
+            if self._pending_list and not self._header_saved:
+                writer.writerow([''] + self._header)
+                self._header_saved = True
+            for detail in self._pending_list:
+                writer.writerow(
+                    [self._saved_size]
+                    + [detail.get(key, '') for key in self._header]
+                )
+                self._saved_size += 1
+        self._pending_list = []
 
-    @property
-    def summary(self):
-        df = pd.DataFrame(self._detail_list)
-        mask = df['successful']
-        success_rate = mask.sum() / df.shape[0]
+        self.save_summary(result_dir)
+
+    def load_detail(self, result_dir):
+        path = os.path.join(result_dir, 'detail.csv')
+        if not os.path.exists(path):
+            return
 
-        cost_series = df['cost'][mask]
-        linf_series = df['linf'][mask]
-        l2_series = df['l2'][mask]
+        # a run preempted while writing leaves a partial last row; it is
+        # dropped and cut off the file, so that appends start a new row
+        with open(path, 'rb+') as file:
+            content = file.read()
+            end = content.rfind(b'\n') + 1
+            file.truncate(end)
+        if end == 0:
+            return
 
-        mean_cost = cost_series.mean()
-        mean_linf = linf_series.mean()
-        mean_l2 = l2_series.mean()
+        reader = csv.reader(io.StringIO(content[:end].decode(), newline=''))
+        self._header = next(reader)[1:]
+        self._header_saved = True
+        for row in reader:
+            self.append(OrderedDict(
+                (key, _parse_value(value))
+                for key, value in zip(self._header, row[1:])
+            ))
 
-        median_cost = cost_series.median()
-        median_linf = linf_series.median()
-        median_l2 = l2_series.median()
+        self._pending_list = []
+        self._saved_size = self._size
 
+    @property
+    def summary(self):
         return OrderedDict([
-            ('success rate', success_rate),
-            ('mean cost', mean_cost),
-            ('mean pixel linf', mean_linf),
-            ('mean l2', mean_l2),
-            ('median cost', median_cost),
-            ('median pixel linf', median_linf),
-            ('median l2', median_l2),
+            ('success rate', _ratio(self._success_count, self._size)),
+            ('mean cost', self._cost.mean),
+            ('mean pixel linf', self._linf.mean),
+            ('mean l2', self._l2.mean),
+            ('median cost', self._cost.median),
+            ('median pixel linf', self._linf.median),
+            ('median l2', self._l2.median),
         ])
 
     def print_summary(self):
         print('-' * 30)
         print('**summary**')
-        print(pd.Series(self.summary))
+        _print_dict(self.summary)
         print('-' * 30)
 
     def save_summary(self, result_dir):
-        pd.Series(self.summary).to_csv(
-            os.path.join(result_dir, 'summary.csv'), header=False
-        )
+        # replaced in one step, so it is never seen half written
+        path = os.path.join(result_dir, 'summary.csv')
+        with open(path + '.tmp', 'w', newline='') as file:
+            csv.writer(file).writerows(self.summary.items())
+        os.replace(path + '.tmp', path)
+
+
+class _RunningStatistic:
+
+    # the mean and the median of the values added so far, kept up to date
+    # in O(log n) per value: the lower half of the values is a max-heap
+    # (negated), the upper half a min-heap of at most the same size
+
+    def __init__(self):
+        self._total = 0
+        self._lower = []
+        self._upper = []
+
+    def add(self, value):
+        self._total += value
+        if self._lower and value > -self._lower[0]:
+            heapq.heappush(self._upper, value)
+        else:
+            heapq.heappush(self._lower, -value)
+
+        if len(self._lower) > len(self._upper) + 1:
+            heapq.heappush(self._upper, -heapq.heappop(self._lower))
+        elif len(self._upper) > len(self._lower):
+            heapq.heappush(self._lower, -heapq.heappop(self._upper))
+
+    @property
+    def mean(self):
+        return _ratio(self._total, len(self._lower) + len(self._upper))
+
+    @property
+    def median(self):
+        if not self._lower:
+            return math.nan
+        if len(self._lower) > len(self._upper):
+            return -self._lower[0]
+        return (-self._lower[0] + self._upper[0]) / 2
+
+
+def _print_dict(dictionary):
+    width = max(len(key) for key in dictionary) + 4
+    for key, value in dictionary.items():
+        print(f'{key:<{width}}{value}')
+
+
+def _parse_value(value):
+    if value in ('True', 'False'):
+        return value == 'True'
+    for parse in (int, float):
+        try:
+            return parse(value)
+        except ValueError:
+            pass
+    return value
+
+
+def _ratio(numerator, denominator):
+    return numerator / denominator if denominator else math.nan
+
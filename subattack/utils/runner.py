@@ -0,0 +1,240 @@
+import os
+import re
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from subattack.utils.data import generate_1by1
+from subattack.utils.data import idx_to_label
+from subattack.utils.data import select_attack_indices
+from subattack.utils.parallel import run_sharded
+from subattack.utils.brokers import QueryBroker
+from subattack.utils.results import AttackResult
+from subattack.utils.results import AttackDetailCollection
+from subattack.utils.results import ImageWriter
+from subattack.strategies.adv_checkers import AdvChecker
+
+
+def get_original_dir(result_dir, *key_list):
+    # clean originals only depend on the split and the model, so with
+    # save_original = once they are shared by all runs on the same split;
+    # keys such as urls and paths are flattened into one directory name
+    return os.path.join(result_dir, 'original', '_'.join(
+        re.sub(r'[^\w.-]+', '-', str(key)).strip('-') for key in key_list
+    ))
+
+
+class AttackRunner:
+    """Runs the attack loop of the main scripts and records its results
+
+    The first num_attack images of attack_loader which predict_batch
+    classifies correctly are attacked in order, serially, in worker
+    processes or in threads. Their details are appended to detail.csv in
+    result_dir as they finish, and a result_dir which already holds some
+    is resumed after them. The solve functions return adv_image, adv_label
+    and cost, optionally followed by cache_hits. seed(order) is called
+    before every attack run on its own. count_queries, if given, returns an
+    OrderedDict of the query counters of the model and the predictor,
+    which query_counts sums over the worker processes as well.
+    """
+
+    def __init__(
+            self, attack_loader, predict_batch, adv_checker: AdvChecker,
+            result_dir, num_attack, seed, device='cpu',
+            save_original='always', original_dir=None, save_threads=2,
+            count_queries=None
+    ):
+        self._attack_loader = attack_loader
+        self._predict_batch = predict_batch
+        self._adv_checker = adv_checker
+        self._result_dir = result_dir
+        self._num_attack = num_attack
+        self._seed = seed
+        self._device = device
+        self._save_original = save_original
+        self._original_dir = original_dir
+        self._count_queries = count_queries
+        self._worker_counts = None
+
+        self._attack_detail_collection = AttackDetailCollection()
+        self._attack_detail_collection.load_detail(result_dir)
+        self._image_writer = ImageWriter(save_threads)
+
+        if save_original == 'once':
+            os.makedirs(original_dir, exist_ok=True)
+
+    @property
+    def count(self):
+        # when resuming, the images already in detail.csv are skipped
+        return len(self._attack_detail_collection)
+
+    @property
+    def query_counts(self):
+        counts = (
+            OrderedDict() if self._count_queries is None
+            else self._count_queries()
+        )
+        if self._worker_counts is not None:
+            for key in counts:
+                counts[key] += self._worker_counts[key]
+        return counts
+
+    def run(self, solve):
+        for image, label in self._select_images():
+            self._seed(self.count)
+            self._record(image, label, *solve(image, label))
+
+    def run_stream(self, solve_stream):
+        # solve_stream takes an iterator of (image, label), attacks them
+        # side by side and yields their results in order; it shares the
+        # global RNG between the attacks, so it is seeded once
+        self._seed(self.count)
+
+        image_iterator, record_iterator = itertools.tee(self._select_images())
+        for (image, label), result in zip(
+                record_iterator, solve_stream(image_iterator)
+        ):
+            self._record(image, label, *result)
+
+    def run_sharded(self, solve, num_workers):
+
+        # workers are forked, which is unsafe once CUDA is in use
+        assert self._device == 'cpu'
+
+        offset = self.count
+
+        def attack(order, index):
+            order += offset
+            self._seed(order)
+            image, label = self._load(index)
+            return self._evaluate(order, image, label, *solve(image, label))
+
+        def finalize():
+            self._image_writer.close()
+            return self.query_counts
+
+        index_list = self._select_indices()[offset:]
+
+        # the workers start from copies of the counters at the fork, so
+        # only what they add to them is summed up
+        fork_counts = self.query_counts
+        final_counts_list = []
+        for detail in run_sharded(
+                attack, index_list, num_workers,
+                finalize=finalize, collect=final_counts_list.append
+        ):
+            self._append(detail)
+
+        self._worker_counts = OrderedDict(
+            (key, sum(
+                final_counts[key] - value
+                for final_counts in final_counts_list
+            ))
+            for key, value in fork_counts.items()
+        )
+
+    def run_threaded(
+            self, solve_in_thread, model, num_threads, batch_size, wait
+    ):
+
+        # every attack runs over its own client of a broker, which batches
+        # the queries of all of them into single forward passes;
+        # solve_in_thread(client, image, label) builds its attacker on the
+        # client. The threads share the global RNG, so unlike run_sharded
+        # the results depend on the scheduling
+        broker = QueryBroker(model, batch_size, wait)
+
+        def attack(order, index):
+            image, label = self._load(index)
+            return self._evaluate(
+                order, image, label,
+                *solve_in_thread(broker.client(), image, label)
+            )
+
+        index_list = self._select_indices()
+        with ThreadPoolExecutor(num_threads) as executor:
+            for detail in executor.map(
+                    attack,
+                    range(self.count, len(index_list)),
+                    index_list[self.count:]
+            ):
+                self._append(detail)
+        broker.close()
+
+        print(
+            f'broker: {broker.batch_count} batches, '
+            f'mean batch size {broker.mean_batch_size:f}'
+        )
+
+    def close(self):
+        self._image_writer.close()
+
+        self._attack_detail_collection.print_summary()
+        self._attack_detail_collection.save_summary(self._result_dir)
+
+    def _select_images(self):
+        # the correctly classified images still to attack, in order
+        skip_count = self.count
+        remaining = self._num_attack - self.count
+        for image, label in generate_1by1(self._attack_loader, self._device):
+
+            if remaining <= 0:
+                return
+
+            pred_label = self._predict_batch(image.unsqueeze(0)).squeeze(0)
+            if pred_label != label:
+                continue
+
+            if skip_count > 0:
+                skip_count -= 1
+                continue
+
+            remaining -= 1
+            yield image, label
+
+    def _select_indices(self):
+        return select_attack_indices(
+            self._attack_loader, self._predict_batch, self._num_attack,
+            self._device
+        )
+
+    def _load(self, index):
+        image, label = self._attack_loader.dataset[index]
+        return (
+            image.to(self._device), torch.tensor(label, device=self._device)
+        )
+
+    def _evaluate(self, order, image, label, adv_image, adv_label, cost,
+                  cache_hits=None):
+
+        print('{}/{}'.format(order+1, self._num_attack))
+        attack_result = AttackResult(
+            image, label, adv_image, adv_label, cost, self._adv_checker,
+            cache_hits
+        )
+
+        if self._save_original == 'always':
+            attack_result.save_image(
+                order, idx_to_label, self._result_dir, self._image_writer
+            )
+        elif self._save_original == 'once':
+            attack_result.save_image(
+                order, idx_to_label, self._original_dir, self._image_writer,
+                overwrite=False
+            )
+        attack_result.save_adv_image(
+            order, idx_to_label, self._result_dir, self._image_writer
+        )
+
+        attack_result.print_detail()
+
+        return attack_result.detail
+
+    def _record(self, image, label, *result):
+        self._append(self._evaluate(self.count, image, label, *result))
+
+    def _append(self, detail):
+        self._attack_detail_collection.append(detail)
+        self._attack_detail_collection.save_detail(self._result_dir)
@@ -0,0 +1,109 @@
+import torch
+
+
+def drive(steps, evaluate):
+    """Runs a step-wise attack to its end
+
+    steps is a generator which yields every batch of images it needs
+    evaluated and is sent back evaluate(batch); its return value, the
+    result of the attack, is returned.
+    """
+    try:
+        image_array = next(steps)
+        while True:
+            image_array = steps.send(evaluate(image_array))
+    except StopIteration as stop:
+        return stop.value
+
+
+def drive_interleaved(steps_list, evaluate, max_batch_size=None):
+    """Runs step-wise attacks side by side, batching their queries
+
+    In every round, the pending batches of all running attacks are
+    concatenated into calls of evaluate of at most max_batch_size images
+    (a single batch is never split), and the results are sent back to
+    their attacks. Every attack must own its attacker, unless its steps
+    keep their state to themselves as GradientAttacker.solve_steps does.
+    The results are returned in the order of steps_list.
+    """
+    return list(drive_continuous(
+        steps_list, evaluate, len(steps_list), max_batch_size
+    ))
+
+
+def drive_continuous(
+        steps_iterable, evaluate, max_active, max_batch_size=None
+):
+    """Runs step-wise attacks side by side, refilling as they finish
+
+    Up to max_active attacks run at once, batched as in drive_interleaved;
+    whenever one finishes, the next is taken from steps_iterable, so the
+    rounds stay full until it runs dry instead of shrinking to the few
+    longest attacks. The results are yielded in the order of
+    steps_iterable, each once it and all before it are done.
+    """
+    steps_iterator = iter(steps_iterable)
+    steps_dict = {}
+    pending = {}
+    result_dict = {}
+    start_count = 0
+    yield_count = 0
+    while True:
+
+        while len(steps_dict) < max_active:
+            steps = next(steps_iterator, None)
+            if steps is None:
+                break
+            steps_dict[start_count] = steps
+            _advance(steps_dict, None, start_count, pending, result_dict)
+            start_count += 1
+
+        while yield_count in result_dict:
+            yield result_dict.pop(yield_count)
+            yield_count += 1
+
+        if not pending:
+            return
+
+        output_dict = _evaluate_pending(pending, evaluate, max_batch_size)
+        pending = {}
+        for index, output in output_dict.items():
+            _advance(steps_dict, output, index, pending, result_dict)
+
+
+def _evaluate_pending(pending, evaluate, max_batch_size):
+    output_dict = {}
+    index_list = list(pending)
+    start = 0
+    while start < len(index_list):
+        end = start + 1
+        size = pending[index_list[start]].shape[0]
+        while (end < len(index_list) and (
+                max_batch_size is None or
+                size + pending[index_list[end]].shape[0] <= max_batch_size
+        )):
+            size += pending[index_list[end]].shape[0]
+            end += 1
+
+        output = evaluate(torch.cat(
+            [pending[index] for index in index_list[start:end]]
+        ))
+        offset = 0
+        for index in index_list[start:end]:
+            size = pending[index].shape[0]
+            output_dict[index] = output[offset:offset + size]
+            offset += size
+        start = end
+
+    return output_dict
+
+
+def _advance(steps_dict, output, index, pending, result_dict):
+    steps = steps_dict[index]
+    try:
+        pending[index] = (
+            next(steps) if output is None else steps.send(output)
+        )
+    except StopIteration as stop:
+        result_dict[index] = stop.value
+        del steps_dict[index]